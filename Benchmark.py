@@ -0,0 +1,150 @@
+import Queue
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+
+import FakePetPoint
+import FetchEngine
+import PageStore
+from ConcurrencyController import ConcurrencyController
+from RetryPolicy import RetryPolicy
+from SessionPool import SessionPool
+
+###########################
+# Settings
+###########################
+# Each configuration crawls the same ANums from a local FakePetPoint server. Unset keys fall back to the defaults
+# below, which mirror Crawler.py's settings.
+settings = {
+    'anums': 500,
+    'server': {'latency': 0.2, 'error_rate': 0.01, 'session_expiry': 60, 'accept_replayed_state': True},
+    'recorded_pages': None,  # Directory of a page store to serve instead of synthetic pages
+    'store': 'directory',
+    'configurations': [
+        {'name': 'serial two-step', 'concurrency': 1, 'sessions': 1, 'single_round_trip': False},
+        {'name': 'fixed 20 two-step', 'concurrency': 20, 'initial_concurrency': 20, 'sessions': 2,
+         'single_round_trip': False, 'target_latency': None},
+        {'name': 'fixed 20 single', 'concurrency': 20, 'initial_concurrency': 20, 'sessions': 2,
+         'single_round_trip': True, 'target_latency': None},
+        {'name': 'adaptive 100 single', 'concurrency': 100, 'initial_concurrency': 10, 'sessions': 4,
+         'single_round_trip': True, 'target_latency': 1.0}
+    ],
+    'output': 'benchmark_results.json',  # Machine readable results for comparing runs; None to skip
+    'log_level': 'INFO'
+}
+defaults = {'concurrency': 50, 'initial_concurrency': 10, 'min_concurrency': 2, 'sessions': 4, 'target_latency': 5.0,
+            'max_requests_per_second': None, 'request_timeout': 30.0, 'single_round_trip': True, 'max_attempts': 5,
+            'retry_base_delay': 0.1, 'retry_max_delay': 2.0}
+###########################
+# Setup Logging
+###########################
+if 'log_level' in settings:
+    level = settings['log_level'].strip()
+else:
+    level = 'WARNING'
+logging.basicConfig(level=logging.getLevelName(level), format='%(asctime)s, %(levelname)s: %(message)s')
+
+payload = dict((field, 'benchmark') for field in FakePetPoint.login_fields)
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[int(round(percent / 100.0 * (len(sorted_values) - 1)))]
+
+
+def run_configuration(server, configuration, a_nums):
+    config = dict(defaults)
+    config.update(configuration)
+    url_template = server.url_template
+    pool_size = -(-config['concurrency'] // config['sessions'])
+
+    def create_session():
+        session = FetchEngine.create_session(pool_size)
+        return FetchEngine.authenticate(session, url_template, payload, timeout=config['request_timeout'])
+
+    server.reset_stats()
+    start_time = time.time()
+    # Every section expanded, sent with each request the way Crawler.py does
+    cookie_names = ['rbCookie1rbBodysb' + name for name in FakePetPoint.section_names]
+    section_cookies = FetchEngine.get_section_cookies(cookie_names, cookie_names)
+    retry_policy = RetryPolicy(config['max_attempts'], config['retry_base_delay'], config['retry_max_delay'])
+    # Logins can hit an injected error like any other request
+    session_pool = SessionPool(config['sessions'], lambda: retry_policy.run(create_session, 'login'))
+    controller = ConcurrencyController(config['initial_concurrency'], minimum=config['min_concurrency'],
+                                       maximum=config['concurrency'], target_latency=config['target_latency'],
+                                       max_requests_per_second=config['max_requests_per_second'])
+    fetcher = FetchEngine.RecordFetcher(session_pool, controller, url_template, timeout=config['request_timeout'],
+                                        single_round_trip=config['single_round_trip'])
+    q = Queue.Queue()
+    for anum in a_nums:
+        q.put(anum)
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                a = q.get(True, 0)
+            except Queue.Empty:
+                return
+            fetch_start = time.time()
+            # noinspection PyBroadException
+            try:
+                retry_policy.run(fetcher.fetch, 'A' + a, a, section_cookies)
+                with lock:
+                    latencies.append(time.time() - fetch_start)
+            except Exception:
+                logging.debug(traceback.format_exc())
+                with lock:
+                    failures.append(a)
+
+    thread_pool = [threading.Thread(target=worker) for _ in range(config['concurrency'])]
+    for t in thread_pool:
+        t.start()
+    for t in thread_pool:
+        t.join()
+    duration = time.time() - start_time
+    latencies.sort()
+    return {'name': config['name'],
+            'anums': len(a_nums),
+            'completed': len(latencies),
+            'failed': len(failures),
+            'seconds': round(duration, 3),
+            'anums_per_second': round(len(latencies) / duration, 2),
+            'p50_latency': round(percentile(latencies, 50), 4),
+            'p99_latency': round(percentile(latencies, 99), 4),
+            'requests': server.stats['requests'],
+            'bytes_transferred': server.stats['bytes_sent'],
+            'logins': server.stats['logins'],
+            'final_concurrency_limit': int(controller.limit)}
+
+
+###########################
+# Begin Benchmark
+###########################
+pages = None
+if settings['recorded_pages']:
+    pages = PageStore.open_store(settings, settings['recorded_pages'])
+    a_nums = sorted(pages.anums())[:settings['anums']]
+else:
+    a_nums = ['{0:08d}'.format(30000000 + i) for i in range(settings['anums'])]
+fake_server = FakePetPoint.start_server(pages=pages, **settings['server'])
+logging.info('Benchmarking {0} ANum(s) against {1}'.format(len(a_nums), fake_server.url_template))
+
+results = []
+for configuration in settings['configurations']:
+    logging.info('Running configuration {0}...'.format(configuration['name']))
+    result = run_configuration(fake_server, configuration, a_nums)
+    results.append(result)
+    logging.info('{name}: {anums_per_second} ANums/s, p50 {p50_latency}s, p99 {p99_latency}s, {requests} requests, '
+                 '{bytes_transferred} bytes, {logins} logins, {failed} failed.'.format(**result))
+
+fake_server.shutdown()
+if settings['output']:
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), settings['output']), 'w') as out_file:
+        json.dump({'settings': settings['server'], 'results': results}, out_file, indent=2)
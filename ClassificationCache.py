@@ -0,0 +1,50 @@
+import logging
+import os
+
+from CrawlJournal import atomic_write
+
+###########################
+# Classification Cache
+###########################
+# Remembers DataFilter.py's result for each page so reruns only classify new or changed pages. Rows are keyed by ANum
+# and hold the page fingerprint (size and mtime for a directory store, sha1 for a pack store) and the whitelist reason
+# ('' for blacklisted). The first line names the rules version the results were made with; when the rules change the
+# whole cache is discarded.
+
+
+class ClassificationCache(object):
+    def __init__(self, path, rules_version):
+        self.path = path
+        self.rules_version = rules_version
+        self.entries = {}  # anum -> (fingerprint, reason or None)
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as cache_file:
+                header = cache_file.readline().rstrip('\r\n')
+                if header != 'rules\t' + rules_version:
+                    logging.info('Classification rules changed; discarding the cache in {0}.'.format(path))
+                else:
+                    for line in cache_file:
+                        fields = line.rstrip('\r\n').split('\t')
+                        if len(fields) == 3 and line.endswith('\n'):
+                            self.entries[fields[0]] = (fields[1], fields[2] or None)
+                    logging.info('Loaded {0} cached classification(s) from {1}.'.format(len(self.entries), path))
+
+    # Returns (hit, reason); a hit means the page is unchanged since it was classified with the current rules
+    def lookup(self, a_number, fingerprint):
+        entry = self.entries.get(a_number)
+        if entry is not None and entry[0] == fingerprint:
+            self.hits += 1
+            return True, entry[1]
+        self.misses += 1
+        return False, None
+
+    def store(self, a_number, fingerprint, reason):
+        self.entries[a_number] = (fingerprint, reason)
+
+    def save(self):
+        lines = ['rules\t' + self.rules_version]
+        lines.extend('{0}\t{1}\t{2}'.format(a_number, fingerprint, reason or '')
+                     for a_number, (fingerprint, reason) in sorted(self.entries.items()))
+        atomic_write(self.path, '\n'.join(lines) + '\n')
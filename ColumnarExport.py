@@ -0,0 +1,134 @@
+import glob
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+import DateParsing
+import RecordParser
+import RecordStore
+
+###########################
+# Columnar Export
+###########################
+# Writes the record store's animals table and every child table (tests, treatments, location, stage, intakes,
+# outcomes, animal_point_in_time, ...) as its own dataset of Parquet or Arrow IPC files, with anum as the join key and
+# dates as datetime64 columns. Child tables are partitioned by the year of their event date (hive style, year=2016;
+# year=0 holds rows without a date), so a monthly count reads one memory-mapped column of the years it needs.
+# pyarrow is only needed by this module.
+settings = {
+    'database': 'records.sqlite',
+    'output_directory': 'columnar',
+    'format': 'parquet',  # 'parquet' or 'arrow' (uncompressed IPC files, cheapest to memory-map)
+    'partition_by_year': True,
+    'log_level': 'INFO'
+}
+file_extensions = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+
+def table_names():
+    return [RecordStore.animals_table] + [table for _, table, _, _ in RecordStore.child_tables]
+
+
+def event_columns():
+    return dict((table, RecordStore.event_column(fields)) for _, table, fields, _ in RecordStore.child_tables)
+
+
+# Columns whose specification field is parsed by a date parser, per table
+def date_columns():
+    columns = dict((table, RecordStore.date_columns(fields)) for _, table, fields, _ in RecordStore.child_tables)
+    columns[RecordStore.animals_table] = RecordStore.date_columns(RecordParser.record_fields)
+    return columns
+
+
+# One table of the store as a DataFrame. Date columns (from the specifications, so the schema does not depend on the
+# data) become datetime64, with text a date parser could not read as NaT; everything else stays text.
+def read_frame(record_store, table):
+    frame = pd.DataFrame.from_records(record_store.query('SELECT * FROM "{0}"'.format(table)),
+                                      columns=[column[1] for column in record_store.query(
+                                          'PRAGMA table_info("{0}")'.format(table))])
+    table_date_columns = date_columns().get(table, set())
+    for column in frame.columns:
+        if column in table_date_columns:
+            frame[column] = DateParsing.to_datetime64(RecordStore.decode(column, value) for value in frame[column])
+        elif frame[column].dtype == object:
+            frame[column] = frame[column].fillna('').astype(unicode)
+    return frame
+
+
+def write_file(frame, path, file_format):
+    import pyarrow as pa
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(table, path)
+    else:
+        writer = pa.RecordBatchFileWriter(path, table.schema)
+        writer.write_table(table)
+        writer.close()
+
+
+def export_table(record_store, table, directory, file_format='parquet', partition_by_year=True):
+    dataset = os.path.join(directory, table)
+    if os.path.exists(dataset):
+        shutil.rmtree(dataset)
+    os.makedirs(dataset)
+    frame = read_frame(record_store, table)
+    extension = file_extensions[file_format]
+    date_column = event_columns().get(table)
+    if not partition_by_year or date_column is None or date_column not in frame.columns or \
+            not np.issubdtype(frame[date_column].dtype, np.datetime64):
+        write_file(frame, os.path.join(dataset, 'part-0' + extension), file_format)
+        return len(frame)
+    years = frame[date_column].dt.year.fillna(0).astype(int)
+    for year, part in frame.groupby(years):
+        partition = os.path.join(dataset, 'year={0}'.format(year))
+        os.makedirs(partition)
+        write_file(part, os.path.join(partition, 'part-0' + extension), file_format)
+    return len(frame)
+
+
+def export_all(record_store, directory, file_format='parquet', partition_by_year=True):
+    if file_format not in file_extensions:
+        raise ValueError("Unknown columnar format '{0}'; use 'parquet' or 'arrow'.".format(file_format))
+    counts = {}
+    for table in table_names():
+        counts[table] = export_table(record_store, table, directory, file_format, partition_by_year)
+        logging.info('Exported {0} row(s) of {1}.'.format(counts[table], table))
+    return counts
+
+
+# Memory-maps the files of one table and returns the requested columns as a DataFrame; years limits a partitioned
+# table to those year=... partitions
+def read_columns(directory, table, columns, file_format='parquet', years=None):
+    import pyarrow as pa
+    paths = sorted(glob.glob(os.path.join(directory, table, '*' + file_extensions[file_format])) +
+                   glob.glob(os.path.join(directory, table, 'year=*', '*' + file_extensions[file_format])))
+    if years is not None:
+        wanted = set('year={0}'.format(year) for year in years)
+        paths = [path for path in paths if os.path.basename(os.path.dirname(path)) in wanted]
+    tables = []
+    for path in paths:
+        if file_format == 'parquet':
+            import pyarrow.parquet as pq
+            tables.append(pq.read_table(path, columns=columns, memory_map=True))
+        else:
+            table_data = pa.ipc.open_file(pa.memory_map(path)).read_all()
+            tables.append(pa.Table.from_arrays([table_data.column(column) for column in columns], names=columns))
+    if not tables:
+        return pd.DataFrame(columns=columns)
+    return pa.concat_tables(tables).to_pandas()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.getLevelName(settings['log_level']),
+                        format='%(asctime)s, %(levelname)s: %(message)s')
+    start_time = time.time()
+    store = RecordStore.RecordStore(settings['database'])
+    export_all(store, settings['output_directory'], settings['format'], settings['partition_by_year'])
+    store.close()
+    logging.info('Exported {0} to {1} in {2:.1f}s.'.format(settings['database'], settings['output_directory'],
+                                                          time.time() - start_time))
@@ -0,0 +1,63 @@
+import logging
+import threading
+import time
+
+
+###########################
+# Adaptive Concurrency
+###########################
+# AIMD limit on in-flight fetches. Every fetch that finishes within target_latency grows the limit by roughly one
+# per window of limit fetches; a timeout, error or slow fetch multiplies it by decrease_factor (at most once per
+# cooldown so a burst of failures from one slow period only backs off once). An optional requests per second ceiling
+# spaces request start times regardless of the current limit.
+class ConcurrencyController(object):
+    def __init__(self, initial, minimum=1, maximum=50, target_latency=None, max_requests_per_second=None,
+                 decrease_factor=0.5, cooldown=None):
+        self.maximum = max(1, maximum)
+        self.minimum = min(max(1, minimum), self.maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.target_latency = target_latency
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown if cooldown is not None else (target_latency or 1.0)
+        self.interval = 1.0 / max_requests_per_second if max_requests_per_second else 0
+        self.in_flight = 0
+        self.next_request_time = 0
+        self.last_decrease = 0
+        self.reported_limit = int(self.limit)
+        self.condition = threading.Condition()
+        self.rate_lock = threading.Lock()
+
+    # Block until there is room under the current limit
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    # Block until the requests per second ceiling allows another request to start
+    def throttle(self):
+        if not self.interval:
+            return
+        with self.rate_lock:
+            now = time.time()
+            slot = max(now, self.next_request_time)
+            self.next_request_time = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def release(self, latency, succeeded=True, timed_out=False):
+        with self.condition:
+            self.in_flight -= 1
+            now = time.time()
+            slow = self.target_latency is not None and latency > self.target_latency
+            if timed_out or not succeeded or slow:
+                if now - self.last_decrease >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                    self.last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            if int(self.limit) != self.reported_limit:
+                logging.debug('Concurrency limit changed from {0} to {1} (latency {2:.2f}s).'.format(
+                    self.reported_limit, int(self.limit), latency))
+                self.reported_limit = int(self.limit)
+            self.condition.notify_all()
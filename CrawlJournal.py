@@ -0,0 +1,104 @@
+import collections
+import hashlib
+import logging
+import os
+import threading
+import time
+
+###########################
+# Crawl Journal
+###########################
+# Append-only, tab separated record of what happened to each ANum: anum, status, timestamp, bytes, sha1.
+# The last line for an ANum wins. A page only counts as saved once it has been written atomically and its journal
+# line has been flushed, so a crash mid-write leaves the ANum unfinished and it is fetched again on restart.
+SAVED = 'saved'
+FILTERED = 'filtered'
+FAILED = 'failed'
+STREAMED = 'streamed'  # Parsed straight into the database without keeping the page
+finished_statuses = (SAVED, FILTERED, STREAMED)
+
+JournalEntry = collections.namedtuple('JournalEntry', ['anum', 'status', 'timestamp', 'size', 'checksum'])
+
+
+def checksum(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+# Write to a temporary file next to the destination and rename it into place so readers never see partial pages
+def atomic_write(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as out_file:
+        out_file.write(data)
+        out_file.flush()
+        os.fsync(out_file.fileno())
+    if os.name == 'nt' and os.path.exists(path):
+        # os.rename will not replace an existing file on Windows
+        os.remove(path)
+    os.rename(tmp_path, path)
+    return len(data), checksum(data)
+
+
+# Reads a journal file, the last line for an ANum winning. Returns the entries and whether the file ends mid-line.
+def read_journal(path):
+    entries = {}
+    needs_newline = False
+    with open(path, 'rb') as journal_file:
+        for line in journal_file:
+            fields = line.rstrip('\r\n').split('\t')
+            if len(fields) != 5 or not line.endswith('\n'):
+                # A line cut short by a crash is ignored
+                needs_newline = not line.endswith('\n')
+                continue
+            try:
+                entry = JournalEntry(fields[0], fields[1], float(fields[2]), int(fields[3]), fields[4])
+            except ValueError:
+                continue
+            entries[entry.anum] = entry
+    return entries, needs_newline
+
+
+# shared_paths are the journals of other processes crawling into the same directory. They are read on start, the
+# newest entry for an ANum across all the files winning, but only path is written.
+class CrawlJournal(object):
+    def __init__(self, path, shared_paths=()):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.run_counts = collections.Counter()
+        needs_newline = False
+        for journal_path in list(shared_paths) + [path]:
+            if not os.path.exists(journal_path):
+                continue
+            entries, cut_short = read_journal(journal_path)
+            for entry in entries.values():
+                current = self.entries.get(entry.anum)
+                if current is None or entry.timestamp >= current.timestamp:
+                    self.entries[entry.anum] = entry
+            if journal_path == path:
+                needs_newline = cut_short
+            logging.info('Loaded {0} ANum(s) from crawl journal {1}.'.format(len(entries), journal_path))
+        self.journal_file = open(path, 'ab')
+        if needs_newline:
+            self.journal_file.write('\n')
+
+    # count=False keeps entries adopted from an earlier run out of this run's totals
+    def record(self, a_number, status, size=0, digest='', count=True):
+        entry = JournalEntry(a_number, status, time.time(), size, digest)
+        with self.lock:
+            self.journal_file.write('{0}\t{1}\t{2:.3f}\t{3}\t{4}\n'.format(*entry))
+            self.journal_file.flush()
+            self.entries[a_number] = entry
+            if count:
+                self.run_counts[status] += 1
+        return entry
+
+    def get(self, a_number):
+        return self.entries.get(a_number)
+
+    def is_finished(self, a_number):
+        entry = self.entries.get(a_number)
+        return entry is not None and entry.status in finished_statuses
+
+    def close(self):
+        with self.lock:
+            self.journal_file.close()
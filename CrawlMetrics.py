@@ -0,0 +1,180 @@
+import BaseHTTPServer
+import SocketServer
+import bisect
+import collections
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from CrawlJournal import atomic_write
+
+###########################
+# Crawl Metrics
+###########################
+# Latency histograms per phase (login, open, postback, single, write), counters (bytes received, ANums by outcome,
+# retries, filter skips) and gauges sampled on demand (in-flight requests, concurrency limit, queue depths).
+# A background exporter writes a JSON snapshot to a file every interval seconds and/or serves it on a local port:
+# /metrics in Prometheus text format and /metrics.json as JSON.
+latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+
+class Histogram(object):
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last slot is +Inf
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    # Upper bound of the bucket holding the given quantile
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        running = 0
+        for index, bucket_count in enumerate(self.counts):
+            running += bucket_count
+            if running >= target:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def snapshot(self):
+        return {'count': self.count,
+                'sum': round(self.total, 6),
+                'mean': round(self.total / self.count, 6) if self.count else 0.0,
+                'p50': self.quantile(0.5),
+                'p99': self.quantile(0.99),
+                'buckets': collections.OrderedDict(
+                    (str(bound), count) for bound, count in zip(self.buckets + ['+Inf'], self.counts))}
+
+
+class CrawlMetrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = collections.defaultdict(Histogram)
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.start_time = time.time()
+        self.last_snapshot = (self.start_time, 0)
+        self.stop_signal = threading.Event()
+        self.server = None
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            self.histograms[phase].observe(seconds)
+
+    @contextmanager
+    def timer(self, phase):
+        phase_start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.time() - phase_start)
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    # function is called at export time, e.g. lambda: q.qsize()
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def snapshot(self):
+        now = time.time()
+        gauges = {}
+        for name, function in self.gauges.items():
+            # noinspection PyBroadException
+            try:
+                gauges[name] = function()
+            except Exception:
+                gauges[name] = None
+        with self.lock:
+            processed = self.counters['anums_processed']
+            last_time, last_processed = self.last_snapshot
+            self.last_snapshot = (now, processed)
+            elapsed = now - self.start_time
+            return {'timestamp': now,
+                    'elapsed_seconds': round(elapsed, 3),
+                    'anums_per_second': round(processed / elapsed, 3) if elapsed > 0 else 0.0,
+                    'recent_anums_per_second': round((processed - last_processed) / (now - last_time), 3)
+                    if now > last_time else 0.0,
+                    'counters': dict(self.counters),
+                    'gauges': gauges,
+                    'latency': dict((phase, histogram.snapshot()) for phase, histogram in self.histograms.items())}
+
+    def prometheus(self):
+        snapshot = self.snapshot()
+        lines = ['crawler_anums_per_second {0}'.format(snapshot['anums_per_second'])]
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('crawler_{0}_total {1}'.format(name, value))
+        for name, value in sorted(snapshot['gauges'].items()):
+            if value is not None:
+                lines.append('crawler_{0} {1}'.format(name, value))
+        with self.lock:
+            for phase, histogram in sorted(self.histograms.items()):
+                running = 0
+                for bound, count in zip(histogram.buckets + ['+Inf'], histogram.counts):
+                    running += count
+                    lines.append('crawler_latency_seconds_bucket{{phase="{0}",le="{1}"}} {2}'.format(
+                        phase, bound, running))
+                lines.append('crawler_latency_seconds_sum{{phase="{0}"}} {1}'.format(phase, histogram.total))
+                lines.append('crawler_latency_seconds_count{{phase="{0}"}} {1}'.format(phase, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        atomic_write(path, json.dumps(self.snapshot(), indent=2, sort_keys=True))
+
+    def start_exporter(self, path=None, port=None, interval=10.0):
+        if port is not None:
+            self.server = MetricsServer(port, self)
+            server_thread = threading.Thread(target=self.server.serve_forever)
+            server_thread.daemon = True
+            server_thread.start()
+            logging.info('Serving crawl metrics at http://127.0.0.1:{0}/metrics'.format(port))
+        if path is not None:
+            def export():
+                while not self.stop_signal.wait(interval):
+                    self.write(path)
+            export_thread = threading.Thread(target=export)
+            export_thread.daemon = True
+            export_thread.start()
+
+    def stop_exporter(self, path=None):
+        self.stop_signal.set()
+        if path is not None:
+            self.write(path)
+        if self.server is not None:
+            self.server.shutdown()
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format_string, *args):
+        logging.debug('Metrics: ' + format_string % args)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = self.server.metrics.prometheus(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, content_type = json.dumps(self.server.metrics.snapshot(), indent=2), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, metrics):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), MetricsHandler)
+        self.metrics = metrics
@@ -4,15 +4,26 @@ from tkFileDialog import askopenfilename
 from tkinter import messagebox
 
 import Queue
-import cookielib
 import datetime
+import glob
 import logging
-import mechanize
 import os
 import time
 import traceback
-from lxml import html
-from mechanize import ControlNotFoundError
+
+import CrawlJournal
+import CrawlMetrics
+import FetchEngine
+import PageStore
+import RuleEngine
+from ConcurrencyController import ConcurrencyController
+from FetchEngine import AuthenticationError, ControlNotFoundError
+from RecordStore import RecordStore
+from RecrawlScheduler import RecrawlScheduler, query_record_states
+from RetryPolicy import DeadLetterFile, RetryPolicy
+from SessionPool import SessionPool
+from StreamingPipeline import StreamingPipeline
+from WorkLeases import LEASED, PENDING, LeasedQueue, LeaseStore, default_worker_id
 
 ###########################
 # Settings
@@ -26,6 +37,15 @@ settings = {'path': 'C:\\Users\\Kevin\\PycharmProjects\\ParvoCrawler\\parvo.txt'
             'skip_downloaded_files': True,
             'filter_keywords': ['parvo'],
             'directory': 'data',  # time.strftime("%Y_%m_%d-%I_%M_%S")
+            'store': 'directory',  # 'directory' for one .htm per ANum, 'pack' for compressed pack files
+            'journal': 'crawl_journal.tsv',  # Per-ANum status log used to resume interrupted crawls
+            'max_attempts': 5,  # Per ANum, including the first try
+            'retry_base_delay': 1.0,  # Seconds; doubled (with jitter) on every further attempt
+            'retry_max_delay': 60.0,
+            'dead_letter': 'dead_letter.txt',  # ANums that failed every attempt, usable as an input file
+            'metrics_file': 'crawl_metrics.json',  # Periodic JSON snapshot of latency, throughput and queue metrics
+            'metrics_port': None,  # Local port serving /metrics (Prometheus text) and /metrics.json; None to disable
+            'metrics_interval': 10,  # Seconds between metrics file exports
             'url_template': 'http://sms.petpoint.com/sms3/embeddedreports/animalviewreport.aspx?AnimalID=',
             'cookies': ["rbCookie1rbBodysbAnimal", "rbCookie1rbBodysbAnimalDetails", "rbCookie1rbBodysbAnimalGroup",
                         "rbCookie1rbBodysbAnimalPIT", "rbCookie1rbBodysbIntake", "rbCookie1rbBodysbOutcome",
@@ -38,7 +58,33 @@ settings = {'path': 'C:\\Users\\Kevin\\PycharmProjects\\ParvoCrawler\\parvo.txt'
                         "rbCookie1rbBodysbLicense",
                         "rbCookie1rbBodysbContacts", "rbCookie1rbBodysbTransferNWRequest", "rbCookie1rbBodysbSchedule",
                         "rbCookie1rbBodysbHotline", "rbCookie1rbBodysbDocumentList"],
-            'concurrency': 50,
+            # Named subsets of cookies to expand; 'full' is always every section in cookies
+            'section_profiles': {'medical': ["rbCookie1rbBodysbAnimal", "rbCookie1rbBodysbCareActivity",
+                                             "rbCookie1rbBodysbLocation", "rbCookie1rbBodysbExam",
+                                             "rbCookie1rbBodysbAnimalMemo"]},
+            'section_profile': 'full',  # Profile of the saved page
+            # Two-tier mode: fetch this cheaper profile first, check filter_keywords against it and only fetch
+            # section_profile for ANums that pass. None fetches section_profile once and filters that.
+            'prefilter_profile': None,
+            'stream_records': False,  # Classify and parse pages in memory as they arrive, writing records to database
+            'persist_pages': True,  # With stream_records, also keep the raw pages in the store
+            'stream_workers': 1,
+            'database': 'records.sqlite',  # Parsed records (RecordStore); shared with Parser.py and SimpleAnalysis.py
+            'recrawl': False,  # Refetch only ANums whose last fetch is stale for their record state
+            'recrawl_intervals': {'active': 0.25, 'open': 1, 'unknown': 7, 'final': None},  # Days; None for never
+            'recrawl_active_window': 14,  # Days since a stage/location change for a record to count as active
+            'coordination_db': None,  # Shared SQLite file; set it to split the input across several crawler processes
+            'worker_id': None,  # Names this process in the coordination db, its packs and dead letter file; host-pid
+            'lease_batch_size': 50,
+            'lease_seconds': 600,
+            'concurrency': 50,  # Ceiling for in-flight fetches; the actual limit adapts to server latency and errors
+            'initial_concurrency': 10,
+            'min_concurrency': 2,
+            'target_latency': 5.0,  # Seconds per ANum fetch above which concurrency is backed off
+            'request_timeout': 30.0,
+            'single_round_trip': True,  # Replay captured postback state to fetch each record in one request
+            'max_requests_per_second': None,  # None for no ceiling
+            'sessions': 4,  # Number of logins shared by all threads; expired sessions are renewed individually
             'log_level': 'WARNING'
             }
 ###########################
@@ -80,6 +126,42 @@ if not os.path.exists(settings['directory']):
     logging.warning('Output directory {0} doesn\'t exist. An attempt will be made to create '
                     'it automatically.'.format(settings['directory']))
     os.mkdir(settings['directory'])
+# The journal path is resolved the same way as the output directory
+if 'journal' not in settings or not settings['journal']:
+    settings['journal'] = 'crawl_journal.tsv'
+if not os.path.isabs(settings['journal']):
+    settings['journal'] = os.path.join(os.path.dirname(input_filename), settings['journal']).strip()
+if 'dead_letter' not in settings or not settings['dead_letter']:
+    settings['dead_letter'] = 'dead_letter.txt'
+if not os.path.isabs(settings['dead_letter']):
+    settings['dead_letter'] = os.path.join(os.path.dirname(input_filename), settings['dead_letter']).strip()
+# In sharded mode several processes share the output directory, so each one writes its own pack files, journal and
+# dead letter file, named after its worker id. A worker resumes from every shard's journal and the unsharded one.
+shard_id = None
+shared_journals = []
+if settings.get('coordination_db'):
+    shard_id = settings.get('worker_id') or default_worker_id()
+    settings['worker_id'] = shard_id
+    journal_root, journal_extension = os.path.splitext(settings['journal'])
+    shared_journals = [settings['journal']] + sorted(glob.glob('{0}-*{1}'.format(journal_root, journal_extension)))
+    settings['journal'] = '{0}-{1}{2}'.format(journal_root, shard_id, journal_extension)
+    shared_journals = [path for path in shared_journals if path != settings['journal']]
+    dead_letter_root, dead_letter_extension = os.path.splitext(settings['dead_letter'])
+    settings['dead_letter'] = '{0}-{1}{2}'.format(dead_letter_root, shard_id, dead_letter_extension)
+journal = CrawlJournal.CrawlJournal(settings['journal'], shared_journals)
+dead_letter = DeadLetterFile(settings['dead_letter'])
+if 'database' in settings and not os.path.isabs(settings['database']):
+    settings['database'] = os.path.join(os.path.dirname(input_filename), settings['database']).strip()
+if settings.get('coordination_db') and not os.path.isabs(settings['coordination_db']):
+    settings['coordination_db'] = os.path.join(os.path.dirname(input_filename), settings['coordination_db']).strip()
+if settings.get('metrics_file') and not os.path.isabs(settings['metrics_file']):
+    settings['metrics_file'] = os.path.join(os.path.dirname(input_filename), settings['metrics_file']).strip()
+metrics = CrawlMetrics.CrawlMetrics()
+# Every filter keyword is found in one pass over the page
+filter_engine = RuleEngine.RuleEngine(RuleEngine.keyword_rules(settings.get('filter_keywords', [])))
+retry_policy = RetryPolicy(settings.get('max_attempts', 1), settings.get('retry_base_delay', 1.0),
+                           settings.get('retry_max_delay', 60.0), on_retry=lambda label: metrics.increment('retries'))
+store = PageStore.open_store(settings, settings['directory'], writer_id=shard_id)
 
 # Read the input file
 f = open(input_filename, 'r')
@@ -95,6 +177,17 @@ except Exception as e:
 if len(a_nums) == 0:
     logging.error('No ANums provided. Exiting.')
     exit()
+# In re-crawl mode the schedule decides what is refetched, so nothing is skipped as already downloaded
+if 'recrawl' in settings and settings['recrawl']:
+    record_states = {}
+    if os.path.exists(settings['database']):
+        record_store = RecordStore(settings['database'])
+        record_states = query_record_states(record_store)
+        record_store.close()
+    scheduler = RecrawlScheduler(journal, record_states, intervals=settings.get('recrawl_intervals'),
+                                 active_window=settings.get('recrawl_active_window', 14))
+    a_nums = scheduler.due(a_nums)
+    settings['skip_downloaded_files'] = False
 ###########################
 # Get Credentials From User
 ###########################
@@ -160,19 +253,23 @@ payload = {
 
 
 ###########################
-# Setup Browser
+# Setup Session
 ###########################
-def get_authenticated_browser_and_cookies(suppress_log=False):
+# Each session is a login with its own connection pool; the workers are spread across a small number of them
+def get_session_count():
+    if 'sessions' in settings and settings['sessions']:
+        return int(settings['sessions'])
+    return 1
+
+
+def get_authenticated_session(suppress_log=False):
     global settings
     if not suppress_log:
-        logging.info("Setting Up Browser/Cookie Jar...")
-    # Setup browser/cookies
-    browser = mechanize.Browser()
-    browser.addheaders = [("User-agent",
-                           "Mozilla/5.0 (X11; U; Linux i686; en-US; rv:1.9.2.13) Gecko/20101206 Ubuntu/10.10 ("
-                           "maverick) Firefox/3.6.13")]
-    cookie_jar = cookielib.LWPCookieJar()
-    browser.set_cookiejar(cookie_jar)
+        logging.info("Setting Up Session/Connection Pool...")
+    pool_size = 1
+    if 'concurrency' in settings and settings['concurrency'] is not None:
+        pool_size = -(-settings['concurrency'] // get_session_count())
+    session = FetchEngine.create_session(pool_size)
 
     ###########################
     # Authenticate Session
@@ -183,100 +280,133 @@ def get_authenticated_browser_and_cookies(suppress_log=False):
         if not suppress_log:
             logging.error('Error: No url_template provided. No requests can be made.')
         exit()
-    # Load a page to generate the login prompt
-    browser.open(settings['url_template'].strip() + '000000000').read()
-    browser.select_form(nr=0)
-    # Login with the user provided credentials
-    for key in payload:
-        browser[key] = payload[key]
-    tmp = browser.submit().read()  # submitting the login credentials
-    if 'Please sign in to continue' in tmp:
-        if not suppress_log:
-            logging.error('Authentication failed due to bad credentials.')
-        exit()
-    return browser, cookie_jar
+    FetchEngine.authenticate(session, settings['url_template'], payload, timeout=settings.get('request_timeout'),
+                             metrics=metrics)
+    # Section cookies are sent with each request for its profile (see fetch_profile), not stored on the session
+    return session
 
 
 ###########################
 # ANum Processing
 ###########################
+# ANums finished in an earlier run according to the journal. Pages saved before the journal existed are only
+# looked up in the store when the journal has no line for them, and are journaled so they are not checked again.
+def is_finished(a_number):
+    if journal.is_finished(a_number):
+        return True
+    if journal.get(a_number) is None and store.contains(a_number):
+        data = store.read(a_number)
+        journal.record(a_number, CrawlJournal.SAVED, len(data), CrawlJournal.checksum(data), count=False)
+        return True
+    return False
+
+
 # This function does all the appropriate processing for each A number
-def process_anum(a_number, browser, cookie_jar):
+def get_profile_cookies(profile):
+    if profile == 'full':
+        enabled_sections = settings['cookies']
+    elif profile in settings.get('section_profiles', {}):
+        enabled_sections = settings['section_profiles'][profile]
+    else:
+        raise KeyError("Unknown section profile '{0}'; add it to section_profiles.".format(profile))
+    return FetchEngine.get_section_cookies(settings['cookies'], enabled_sections)
+
+
+def fetch_profile(a_number, fetcher, profile):
+    try:
+        return fetcher.fetch(a_number, get_profile_cookies(profile))
+    except ControlNotFoundError:
+        logging.debug('ANum {0} did not load properly. Confirm it is a valid ANum and try again.'.format(a_number))
+        raise
+
+
+# The first filter keyword missing from the page, or '' if the page contains all of them
+def find_missing_keyword(page):
+    missing_rules = filter_engine.unmatched(page)
+    return missing_rules[0].name if missing_rules else ''
+
+
+def process_anum(a_number, fetcher):
     global settings
-    if 'skip_downloaded_files' in settings and settings['skip_downloaded_files'] and os.path.exists(
-            os.path.join(settings['directory'], 'A' + a_number + '.htm')):
+    if 'skip_downloaded_files' in settings and settings['skip_downloaded_files'] and is_finished(a_number):
         logging.info("A{0} was skipped because it was already downloaded (set skip_downloaded_files to False to "
                      "redownload).".format(a_number))
+        metrics.increment('anums_skipped')
         return
 
-    # Open the URL for a given anum
-    browser.open(settings['url_template'].strip() + a_number).read()
-
-    # The only way to get the whole details expanded is to set these cookies to 'block'
-    # Set the cookies so all fields are loaded
-    if 'cookies' in settings:
-        for c in settings['cookies']:
-            cookie = cookielib.Cookie(version=0, name=c, value='block', expires=99999, port=None,
-                                      port_specified=False, domain='sms.petpoint.com', domain_specified=True,
-                                      domain_initial_dot=False, path='/sms3/embeddedreports', path_specified=True,
-                                      secure=False, discard=False, comment=None, comment_url=None,
-                                      rest={'HttpOnly': False}, rfc2109=False)
-            cookie_jar.set_cookie(cookie)
-    browser.set_cookiejar(cookie_jar)
-    browser.select_form(nr=0)
-    result = ''
-    # Reload the page
-    try:
-        result = browser.submit("ctl00$cphSearchArea$btnPostBackButton").read()
-    except ControlNotFoundError:
-        logging.debug('ANum {0} did not load properly. Confirm it is a valid ANum and try again.'.format(a_number))
+    # Two-tier mode: a cheap fetch of only the sections the filter needs decides whether the full fetch is worth it
+    prefilter_profile = settings.get('prefilter_profile')
+    if prefilter_profile and 'filter_keywords' in settings:
+        found_key = find_missing_keyword(fetch_profile(a_number, fetcher, prefilter_profile))
+        if found_key != '':
+            logging.info("A{0} was skipped for not containing filter '{1}' in the {2} sections.".format(
+                a_number, found_key, prefilter_profile))
+            journal.record(a_number, CrawlJournal.FILTERED)
+            metrics.increment('anums_filtered')
+            metrics.increment('prefilter_rejected')
+            return
 
-    # Filter based on the filter inputs
-    found_key = ''
-    if 'filter_keywords' in settings:
-        case_insensitive_result = result.lower().strip()
-        for filter_key in settings['filter_keywords']:
-            if filter_key.strip() not in case_insensitive_result:
-                found_key = filter_key.strip()
-                break
+    # Open the URL for a given anum and reload it with the profile's sections expanded
+    result = fetch_profile(a_number, fetcher, settings.get('section_profile', 'full'))
 
+    # Filter based on the filter inputs
+    found_key = find_missing_keyword(result)
     if found_key != '':
         logging.info("A{0} was skipped for not containing filter '{1}'.".format(a_number, found_key))
+        journal.record(a_number, CrawlJournal.FILTERED)
+        metrics.increment('anums_filtered')
         return
     else:
         # At this point the page has passed the filter
-        tree = html.fromstring(result)
-        logging.info("{0} completed successfully.".format(
-            tree.get_element_by_id("cphWorkArea_lblAnimalNumber").text_content().strip()))
+        logging.info("A{0} completed successfully.".format(a_number))
+
+    if pipeline is not None:
+        if 'persist_pages' in settings and not settings['persist_pages']:
+            # The page is not kept, so the ANum is only finished once its record is committed
+            size, digest = len(result), CrawlJournal.checksum(result)
+
+            def streamed():
+                journal.record(a_number, CrawlJournal.STREAMED, size, digest)
+                metrics.increment('anums_streamed')
+            pipeline.submit(a_number, result, streamed)
+            return
+        pipeline.submit(a_number, result)
 
     # Print .htm file
-    out_file = open(os.path.join(settings['directory'], 'A' + a_number + '.htm'), 'w')
-    out_file.write(result)
-    out_file.close()
+    with metrics.timer('write'):
+        size, digest = store.write(a_number, result)
+    journal.record(a_number, CrawlJournal.SAVED, size, digest)
+    metrics.increment('anums_saved')
 
 
-def process_next_anum():
-    global q
+# Retry the ANum with backoff; once every attempt has failed it is journaled and sent to the dead letter file
+def process_anum_with_retries(a_number, fetcher):
     # noinspection PyBroadException
     try:
-        b, c = get_authenticated_browser_and_cookies()
-    except:
-        logging.warning('There was an error authenticating which resulted in a thread not spinning up.')
-        return
+        retry_policy.run(process_anum, 'A' + a_number, a_number, fetcher)
+        return True
+    except Exception:
+        logging.error('There was an error processing the anum, {0}.'.format(a_number))
+        logging.error(traceback.format_exc())
+        journal.record(a_number, CrawlJournal.FAILED)
+        dead_letter.add(a_number)
+        metrics.increment('anums_failed')
+        return False
+    finally:
+        metrics.increment('anums_processed')
+
+
+def process_next_anum(fetcher):
+    global q
     while True:
-        a = None
-        # noinspection PyBroadException
         try:
             a = q.get(True, 0)
-            process_anum(a, b, c)
         except Queue.Empty:
             logging.debug('Closing thread gracefully after empty queue.')
-            exit()
-        except Exception:
-            if a is not None:
-                logging.error('There was an error processing the anum, {0}.'.format(a))
-            logging.error(traceback.print_exc())
-            pass
+            return
+        succeeded = process_anum_with_retries(a, fetcher)
+        if leases is not None:
+            q.complete(a, succeeded)
 
 
 ###########################
@@ -287,31 +417,98 @@ start_time = time.time()
 
 logging.info('Initializing...')
 
+# Serial mode is a fixed single request in flight
+if 'concurrency' in settings:
+    controller = ConcurrencyController(settings.get('initial_concurrency', settings['concurrency']),
+                                       minimum=settings.get('min_concurrency', 1),
+                                       maximum=settings['concurrency'],
+                                       target_latency=settings.get('target_latency'),
+                                       max_requests_per_second=settings.get('max_requests_per_second'))
+else:
+    controller = ConcurrencyController(1, minimum=1, maximum=1,
+                                       max_requests_per_second=settings.get('max_requests_per_second'))
+
+# Records stream into the database as pages pass the filter; Parser.py is not needed afterwards
+pipeline = None
+if 'stream_records' in settings and settings['stream_records']:
+    db = RecordStore(settings['database'])
+    pipeline = StreamingPipeline(db.insert, workers=settings.get('stream_workers', 1), flush=db.flush)
+
+# Log in the configured number of times up front; this also tests the credentials
+try:
+    pool = SessionPool(get_session_count() if 'concurrency' in settings else 1, get_authenticated_session)
+except AuthenticationError:
+    logging.error('Authentication failed due to bad credentials.')
+    exit()
+# Fail now rather than on every ANum if a profile name is misspelled
+for profile_name in (settings.get('section_profile', 'full'), settings.get('prefilter_profile')):
+    if profile_name:
+        get_profile_cookies(profile_name)
+fetcher = FetchEngine.RecordFetcher(pool, controller, settings['url_template'], timeout=settings.get('request_timeout'),
+                                    single_round_trip=settings.get('single_round_trip', False), metrics=metrics)
+
+metrics.gauge('in_flight', lambda: controller.in_flight)
+metrics.gauge('concurrency_limit', lambda: int(controller.limit))
+metrics.gauge('anums_remaining', lambda: len(a_nums) - metrics.counters['anums_processed'])
+if pipeline is not None:
+    metrics.gauge('stream_page_queue_depth', lambda: pipeline.pages.qsize())
+    metrics.gauge('stream_record_queue_depth', lambda: pipeline.records.qsize())
+metrics.start_exporter(settings.get('metrics_file'), settings.get('metrics_port'), settings.get('metrics_interval', 10))
+
+# In sharded mode the input is added to the shared coordination db and every process leases batches from it
+leases = None
+if 'coordination_db' in settings and settings['coordination_db']:
+    leases = LeaseStore(settings['coordination_db'], worker_id=settings.get('worker_id'),
+                        lease_seconds=settings.get('lease_seconds', 600))
+    leases.add(a_nums)
+    logging.info('Worker {0} joined coordination db {1} ({2}).'.format(leases.worker_id, settings['coordination_db'],
+                                                                      dict(leases.counts())))
+    q = LeasedQueue(leases, batch_size=settings.get('lease_batch_size', 50))
+    # Other workers take ANums from the same input, so what is left comes from the coordination db
+    metrics.gauge('anums_remaining', lambda: sum(leases.counts()[state] for state in (PENDING, LEASED)))
+    metrics.gauge('queue_depth', lambda: q.qsize())
+
 if 'concurrency' in settings:
-    logging.info('Setting up concurrency with {0} thread(s).'.format(settings['concurrency']))
-    # Test Credentials
-    get_authenticated_browser_and_cookies(suppress_log=True)
+    logging.info('Setting up concurrency with up to {0} thread(s).'.format(settings['concurrency']))
     # Construct Queue
-    q = Queue.Queue(len(a_nums))
-    for anum in a_nums:
-        q.put(anum)
-    # Spawn Threads
+    if leases is None:
+        q = Queue.Queue(len(a_nums))
+        for anum in a_nums:
+            q.put(anum)
+        metrics.gauge('queue_depth', lambda: q.qsize())
+    # Spawn Threads (one per slot at the ceiling; the controller decides how many may fetch at once)
     thread_pool = []
     for i in range(settings['concurrency']):
-        t = Thread(target=process_next_anum)
+        t = Thread(target=process_next_anum, args=(fetcher,))
         thread_pool.append(t)
         t.start()
     # Wait for Queue to complete
     while any([t.isAlive() for t in thread_pool]):
         time.sleep(0.1)
     time.sleep(1)
+elif leases is not None:
+    logging.info('Running in serial mode.')
+    process_next_anum(fetcher)
 else:
     logging.info('Running in serial mode.')
     # Parse all anums sequentially
-    br, cj = get_authenticated_browser_and_cookies()
     for anum in a_nums:
-        process_anum(anum, br, cj)
+        process_anum_with_retries(anum, fetcher)
+
+if leases is not None:
+    q.close()
+    logging.info('Coordination db state: {0}.'.format(dict(leases.counts())))
+    leases.close()
 
-num_files = sum(os.path.isfile(os.path.join(settings['directory'], f)) for f in os.listdir(settings['directory']))
-logging.info('Process completed in {0}. {1} files saved out of {2} requested.'.format(
-    str(datetime.timedelta(seconds=time.time()-start_time)), num_files, len(a_nums)))
+if pipeline is not None:
+    pipeline.close()
+    db.close()
+journal.close()
+store.close()
+dead_letter.report()
+metrics.stop_exporter(settings.get('metrics_file'))
+num_files = sum(journal.get(a) is not None and journal.get(a).status == CrawlJournal.SAVED for a in set(a_nums))
+logging.info('Process completed in {0}. {1} files saved out of {2} requested ({3} this run, {4} filtered, '
+             '{5} failed).'.format(str(datetime.timedelta(seconds=time.time()-start_time)), num_files, len(a_nums),
+                                   journal.run_counts[CrawlJournal.SAVED], journal.run_counts[CrawlJournal.FILTERED],
+                                   journal.run_counts[CrawlJournal.FAILED]))
@@ -1,80 +1,119 @@
 import logging
+import multiprocessing
 import os
 import time
-import re
+
+import PageClassifier
+import PageStore
+from ClassificationCache import ClassificationCache
 
 settings = {
     'directory': 'data',
+    'store': 'directory',  # Must match the store the crawler wrote with ('directory' or 'pack')
     'input_filename': 'parvo.txt',
-    'concurrency': None,  # This script often runs faster w/o concurrency due the database and proc requirements
+    'concurrency': None,  # Worker processes classifying pages in parallel; None classifies in this process
+    'chunk_size': 64,  # ANums handed to a worker process at a time
+    'classification_cache': 'classification_cache.tsv',  # Results reused for unchanged pages; None to disable
     'log_level': 'INFO'
 }
-###########################
-# Setup Logging
-###########################
-if 'log_level' in settings:
-    level = settings['log_level'].strip()
-else:
-    level = 'WARNING'
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s, %(levelname)s: %(message)s',
-                    filename='{0}.log'.format(time.strftime("%Y_%m_%d-%I_%M_%S")))
-# define a Handler which writes INFO messages or higher to the sys.stderr
-console = logging.StreamHandler()
-console.setLevel(logging.getLevelName(level))
-# tell the handler to use this format
-console.setFormatter(logging.Formatter('%(asctime)s, %(levelname)s: %(message)s'))
-# add the handler to the root logger
-logging.getLogger('').addHandler(console)
+# Pool workers on Windows re-import this module, so the script only runs when started directly
+if __name__ == '__main__':
+    ###########################
+    # Setup Logging
+    ###########################
+    if 'log_level' in settings:
+        level = settings['log_level'].strip()
+    else:
+        level = 'WARNING'
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s, %(levelname)s: %(message)s',
+                        filename='{0}.log'.format(time.strftime("%Y_%m_%d-%I_%M_%S")))
+    # define a Handler which writes INFO messages or higher to the sys.stderr
+    console = logging.StreamHandler()
+    console.setLevel(logging.getLevelName(level))
+    # tell the handler to use this format
+    console.setFormatter(logging.Formatter('%(asctime)s, %(levelname)s: %(message)s'))
+    # add the handler to the root logger
+    logging.getLogger('').addHandler(console)
 
-if not ('input_filename' in settings and os.path.exists(settings['input_filename'])):
-    logging.error('input_filename not found.')
-    exit()
-# Read the input file
-f = open(settings['input_filename'], 'r')
-lines = f.readlines()
-f.close()
-a_nums = []
-try:
-    a_nums = [str(line[1:].strip()) for line in lines]
-except Exception as e:
-    logging.error('There was an error parsing the input file. '
-                  'Ensure it is a proper format (newline separated A# list).')
-    logging.debug(e)
-if len(a_nums) == 0:
-    logging.error('No ANums provided. Exiting.')
-    exit()
+    if not ('input_filename' in settings and os.path.exists(settings['input_filename'])):
+        logging.error('input_filename not found.')
+        exit()
+    # Read the input file
+    f = open(settings['input_filename'], 'r')
+    lines = f.readlines()
+    f.close()
+    a_nums = []
+    try:
+        a_nums = [str(line[1:].strip()) for line in lines]
+    except Exception as e:
+        logging.error('There was an error parsing the input file. '
+                      'Ensure it is a proper format (newline separated A# list).')
+        logging.debug(e)
+    if len(a_nums) == 0:
+        logging.error('No ANums provided. Exiting.')
+        exit()
 
-parvo_test_regex = re.compile("<td>\s*Parvo Test \(IDEXX\)</td><td>.*</td><td>Positive</td>")
+    whitelist = open(os.path.join(os.path.dirname(__file__), 'whitelist.txt'), 'w')
+    blacklist = open(os.path.join(os.path.dirname(__file__), 'blacklist.txt'), 'w')
+    missing = open(os.path.join(os.path.dirname(__file__), 'missing.txt'), 'w')
+    store_directory = os.path.join(os.path.dirname(__file__), settings['directory'])
+    store = PageStore.open_store(settings, store_directory)
 
-whitelist = open(os.path.join(os.path.dirname(__file__), 'whitelist.txt'), 'w')
-blacklist = open(os.path.join(os.path.dirname(__file__), 'blacklist.txt'), 'w')
-missing = open(os.path.join(os.path.dirname(__file__), 'missing.txt'), 'w')
+    cache = None
+    if 'classification_cache' in settings and settings['classification_cache']:
+        cache = ClassificationCache(os.path.join(os.path.dirname(__file__), settings['classification_cache']),
+                                    PageClassifier.rules_version)
 
-for anum in a_nums:
-    anum_file_string = 'A{0}'.format(anum)
-    file_path = os.path.join(os.path.dirname(__file__), settings['directory'], anum_file_string + '.htm').replace("/", "\\")
-    if not os.path.exists(file_path):
-        logging.info("{0} skipped because file does not exist.".format(anum))
-        missing.write(anum_file_string + "\n")
-        continue
-    with open(file_path, 'r') as f:
-        text = f.read()
-        search_text = text.lower()
-        is_whitelist = True
-        if 'Parvo-Dog'.lower() in search_text or 'Parvo Ward'.lower() in search_text:
-            logging.info('{0} whitelisted for containing containing non-case-sensitive location tags.'.format(anum))
-        elif 'parvo treatment' in search_text:
-            logging.info('{0} whitelisted for containing \'parvo treatment\' non-case-sensitive.'.format(anum))
-        elif bool(parvo_test_regex.search(text)):
-            logging.info('{0} whitelisted for containing parvo positive test regex, case-sensitive.'.format(anum))
+    # Only pages that are new, changed or classified under other rules are read
+    fingerprints = dict((anum, store.fingerprint(anum)) for anum in a_nums)
+    cached = {}
+    stale = []
+    for anum in a_nums:
+        if fingerprints[anum] is None:
+            continue
+        hit, cached_reason = cache.lookup(anum, fingerprints[anum]) if cache is not None else (False, None)
+        if hit:
+            cached[anum] = cached_reason
         else:
-            is_whitelist = False
-            logging.info('{0} blacklisted for failing all tests.'.format(anum))
-        if is_whitelist:
+            stale.append(anum)
+    if cache is not None:
+        logging.info('{0} page(s) unchanged since the last run; classifying {1}.'.format(len(cached), len(stale)))
+
+    pool = None
+    if 'concurrency' in settings and settings['concurrency']:
+        # Results are merged in input order, so the output files match a serial run
+        pool = multiprocessing.Pool(settings['concurrency'], PageClassifier.init_worker, (settings, store_directory))
+        results = pool.imap(PageClassifier.classify_in_worker, stale, settings.get('chunk_size', 64))
+    else:
+        results = (PageClassifier.classify_stored_page(store, anum) for anum in stale)
+
+    for anum in a_nums:
+        anum_file_string = 'A{0}'.format(anum)
+        if anum in cached:
+            is_missing, reason = False, cached[anum]
+        elif fingerprints[anum] is None:
+            is_missing, reason = True, None
+        else:
+            _, is_missing, reason = next(results)
+            if cache is not None and not is_missing:
+                cache.store(anum, fingerprints[anum], reason)
+        if is_missing:
+            logging.info("{0} skipped because file does not exist.".format(anum))
+            missing.write(anum_file_string + "\n")
+            continue
+        if reason is not None:
+            logging.info('{0} whitelisted for {1}.'.format(anum, reason))
             whitelist.write(anum_file_string + "\n")
         else:
+            logging.info('{0} blacklisted for failing all tests.'.format(anum))
             blacklist.write(anum_file_string + "\n")
 
-whitelist.close()
-blacklist.close()
-missing.close()
\ No newline at end of file
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if cache is not None:
+        cache.save()
+    whitelist.close()
+    blacklist.close()
+    missing.close()
+    store.close()
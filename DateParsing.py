@@ -0,0 +1,86 @@
+import re
+import threading
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+###########################
+# Date Parsing
+###########################
+# PetPoint writes every date as %m/%d/%Y or %m/%d/%Y %I:%M%p, and the same strings repeat across the rows of a
+# record and across records. The fixed formats are matched with one precompiled regex and the results are memoized in
+# a bounded cache. Anything the fast path does not recognise goes to datetime.strptime, so results and errors are the
+# same as calling strptime directly.
+timestamp_format = '%m/%d/%Y %I:%M%p'
+date_format = '%m/%d/%Y'
+timestamp_regex = re.compile(r'^(\d{1,2})/(\d{1,2})/(\d{4}) (\d{1,2}):(\d{2})([AaPp])[Mm]$')
+date_regex = re.compile(r'^(\d{1,2})/(\d{1,2})/(\d{4})$')
+cache_size = 100000  # Entries per format; the cache is emptied when it fills
+
+
+class DateCache(object):
+    def __init__(self, parse, max_size=cache_size):
+        self.parse = parse
+        self.max_size = max_size
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, text):
+        value = self.values.get(text)
+        if value is None:
+            value = self.parse(text)  # Errors are raised, not cached
+            with self.lock:
+                if len(self.values) >= self.max_size:
+                    self.values.clear()
+                self.values[text] = value
+        return value
+
+
+def fast_timestamp(text):
+    match = timestamp_regex.match(text)
+    if match is not None:
+        month, day, year, hour, minute = [int(group) for group in match.groups()[:5]]
+        if 1 <= month <= 12 and 1 <= day <= 31 and 1 <= hour <= 12 and minute <= 59:
+            hour %= 12
+            if match.group(6) in 'Pp':
+                hour += 12
+            return datetime(year, month, day, hour, minute)
+    return datetime.strptime(text, timestamp_format)
+
+
+def fast_date(text):
+    match = date_regex.match(text)
+    if match is not None:
+        month, day, year = [int(group) for group in match.groups()]
+        if 1 <= month <= 12 and 1 <= day <= 31:
+            return datetime(year, month, day)
+    return datetime.strptime(text, date_format)
+
+
+# Drop-in replacements for datetime.strptime(text, timestamp_format) and datetime.strptime(text, date_format)
+parse_timestamp = DateCache(fast_timestamp)
+parse_date = DateCache(fast_date)
+
+
+# A parsed value, or None when the value is empty or not a PetPoint date
+def parse_any(value):
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, basestring) and value.strip():
+        for parse in (parse_timestamp, parse_date):
+            try:
+                return parse(value.strip())
+            except ValueError:
+                pass
+    return None
+
+
+# Vectorized conversion of a column (datetimes, PetPoint date strings, '' or None) to datetime64; values that are not
+# dates become NaT. Each distinct value is parsed once.
+def to_datetime64(values, unit='s'):
+    codes, uniques = pd.factorize(pd.Series(list(values), dtype=object))
+    parsed = np.array([parse_any(value) or np.datetime64('NaT') for value in uniques] + [np.datetime64('NaT')],
+                      dtype='datetime64[{0}]'.format(unit))
+    # Missing values are coded -1, which picks the trailing NaT
+    return parsed[codes]
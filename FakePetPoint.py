@@ -0,0 +1,220 @@
+import BaseHTTPServer
+import Cookie
+import SocketServer
+import cgi
+import gzip
+import logging
+import random
+import threading
+import time
+import urlparse
+import uuid
+from StringIO import StringIO
+
+###########################
+# Local PetPoint Stand-in
+###########################
+# Serves the parts of sms.petpoint.com the crawler touches: the login form, animalviewreport.aspx?AnimalID=, the
+# rbCookie1rbBodysb* section cookies and the postback button. Pages are synthetic (deterministic per ANum) or
+# recorded pages from a PageStore. Latency, error rate, session expiry and whether replayed postback state is
+# accepted are configurable so crawler configurations can be compared offline.
+settings = {
+    'port': 8080,
+    'latency': 0.2,  # Mean seconds per response
+    'error_rate': 0.0,  # Fraction of requests answered with HTTP 500
+    'session_expiry': None,  # Seconds a login stays valid; None for never
+    'accept_replayed_state': True,  # Whether a postback replayed against another ANum returns that ANum
+    'parvo_rate': 0.2,  # Fraction of synthetic animals whose record mentions parvo
+    'memo_rows': 40,  # Upper bound on synthetic memo/treatment rows per animal
+    'log_level': 'INFO'
+}
+
+report_path = '/sms3/embeddedreports/animalviewreport.aspx'
+login_fields = ["ctl00$cphSearchArea$txtShelterPetFinderId", "ctl00$cphSearchArea$txtUserName",
+                "ctl00$cphSearchArea$txtPassword"]
+postback_button = "ctl00$cphSearchArea$btnPostBackButton"
+section_names = ["Animal", "AnimalDetails", "AnimalGroup", "AnimalPIT", "Intake", "Outcome", "Ownership", "LostFound",
+                 "CareActivity", "Stage", "Location", "AnimalHold", "Microchip", "AnimalTag", "Exam",
+                 "BehaviorTestsCompleted", "BehaviorTestsScheduled", "AnimalMemo", "Voucher", "Waiver", "Profile",
+                 "Foster", "Case", "License", "Contacts", "TransferNWRequest", "Schedule", "Hotline", "DocumentList"]
+
+login_page = '''<html><body><form method="post" action="{action}">
+<p>Please sign in to continue</p>
+<input type="text" name="ctl00$cphSearchArea$txtShelterPetFinderId" value="" />
+<input type="text" name="ctl00$cphSearchArea$txtUserName" value="" />
+<input type="password" name="ctl00$cphSearchArea$txtPassword" value="" />
+<input type="submit" name="ctl00$cphSearchArea$btnLogin" value="Login" />
+</form></body></html>'''
+
+record_page = '''<html><body><form method="post" action="{action}">
+<input type="hidden" name="__VIEWSTATE" value="{view_state}" />
+<input type="hidden" name="__EVENTVALIDATION" value="{event_validation}" />
+<input type="submit" name="ctl00$cphSearchArea$btnPostBackButton" value="Refresh" />
+<table><tr><td>Animal Number:</td><td><span id="cphWorkArea_lblAnimalNumber">A{anum}</span></td></tr></table>
+{sections}
+</form></body></html>'''
+
+missing_page = '''<html><body><p>No animal found.</p></body></html>'''
+
+
+# Deterministic synthetic section bodies for one animal
+def synthetic_sections(a_number, expanded_sections):
+    rng = random.Random(a_number)
+    has_parvo = rng.random() < settings['parvo_rate']
+    rows = rng.randint(1, max(1, settings['memo_rows']))
+    sections = []
+    for name in section_names:
+        if name not in expanded_sections:
+            sections.append('<div id="sb{0}" style="display:none"></div>'.format(name))
+            continue
+        body = ['<div id="sb{0}"><table><tr><td>{0}</td></tr>'.format(name)]
+        for row in range(rows if name in ('AnimalMemo', 'CareActivity', 'Location', 'Stage') else 2):
+            month, day, hour = rng.randint(1, 12), rng.randint(1, 28), rng.randint(1, 12)
+            text = 'Parvo Ward' if has_parvo and row == 0 and name == 'Location' else 'Kennel {0}'.format(row)
+            body.append('<tr><td>{0}</td><td>{1:02d}/{2:02d}/2016 {3}:00PM</td><td>{4}</td></tr>'.format(
+                name, month, day, hour, text))
+        body.append('</table></div>')
+        sections.append(''.join(body))
+    return '\n'.join(sections)
+
+
+class FakePetPointHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, as IIS does
+
+    def log_message(self, format_string, *args):
+        logging.debug('FakePetPoint: ' + format_string % args)
+
+    def do_GET(self):
+        self.handle_request({})
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        self.handle_request(urlparse.parse_qs(self.rfile.read(length)))
+
+    def handle_request(self, form):
+        server = self.server
+        url = urlparse.urlparse(self.path)
+        if url.path != report_path:
+            return self.respond(404, 'Not found')
+        time.sleep(server.latency * random.uniform(0.5, 1.5))
+        if random.random() < server.error_rate:
+            server.count('errors')
+            return self.respond(500, 'Server error')
+        a_number = urlparse.parse_qs(url.query).get('AnimalID', [''])[0]
+        cookies = Cookie.SimpleCookie(self.headers.getheader('cookie') or '')
+        session_id = cookies['ASP.NET_SessionId'].value if 'ASP.NET_SessionId' in cookies else None
+        action = cgi.escape(self.path, quote=True)
+        if not server.is_signed_in(session_id):
+            if all(form.get(field, [''])[0] for field in login_fields):
+                session_id = server.sign_in()
+                return self.respond(200, self.render_record(a_number, action, cookies, False), session_id)
+            return self.respond(200, login_page.format(action=action))
+        if postback_button in form:
+            # The view state names the ANum it was rendered for; replaying it elsewhere may not be honoured
+            state_anum = form.get('__VIEWSTATE', [''])[0]
+            if state_anum != a_number and not server.accept_replayed_state:
+                a_number = state_anum
+            return self.respond(200, self.render_record(a_number, action, cookies, True))
+        return self.respond(200, self.render_record(a_number, action, cookies, False))
+
+    def render_record(self, a_number, action, cookies, expanded):
+        if len(a_number) != 8 or not a_number.isdigit():
+            return missing_page
+        if expanded and self.server.pages is not None and self.server.pages.contains(a_number):
+            return self.server.pages.read(a_number)
+        expanded_sections = set()
+        if expanded:
+            expanded_sections = set(name for name in section_names
+                                    if 'rbCookie1rbBodysb' + name in cookies and
+                                    cookies['rbCookie1rbBodysb' + name].value == 'block')
+        return record_page.format(action=action, anum=a_number, view_state=a_number,
+                                  event_validation=uuid.uuid4().hex,
+                                  sections=synthetic_sections(a_number, expanded_sections))
+
+    def respond(self, status, body, session_id=None):
+        if 'gzip' in (self.headers.getheader('accept-encoding') or ''):
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as gzip_file:
+                gzip_file.write(body)
+            body = buf.getvalue()
+            encoding = 'gzip'
+        else:
+            encoding = None
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        if session_id is not None:
+            self.send_header('Set-Cookie', 'ASP.NET_SessionId={0}; path=/'.format(session_id))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count('requests')
+        self.server.count('bytes_sent', len(body))
+
+
+class FakePetPointServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, error_rate=0.0, session_expiry=None, accept_replayed_state=True,
+                 pages=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), FakePetPointHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.session_expiry = session_expiry
+        self.accept_replayed_state = accept_replayed_state
+        self.pages = pages
+        self.sessions = {}
+        self.stats = {'requests': 0, 'bytes_sent': 0, 'errors': 0, 'logins': 0, 'expired': 0}
+        self.lock = threading.Lock()
+
+    # 127.0.0.1 rather than localhost: cookielib will not match cookies set for a dotless host name
+    @property
+    def url_template(self):
+        return 'http://127.0.0.1:{0}{1}?AnimalID='.format(self.server_address[1], report_path)
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def sign_in(self):
+        session_id = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[session_id] = time.time()
+            self.stats['logins'] += 1
+        return session_id
+
+    def is_signed_in(self, session_id):
+        with self.lock:
+            signed_in_at = self.sessions.get(session_id)
+            if signed_in_at is None:
+                return False
+            if self.session_expiry is not None and time.time() - signed_in_at > self.session_expiry:
+                del self.sessions[session_id]
+                self.stats['expired'] += 1
+                return False
+            return True
+
+    def reset_stats(self):
+        with self.lock:
+            for key in self.stats:
+                self.stats[key] = 0
+
+
+# Start a server on a background thread; port 0 picks a free port
+def start_server(**options):
+    server = FakePetPointServer(**options)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.getLevelName(settings['log_level']),
+                        format='%(asctime)s, %(levelname)s: %(message)s')
+    fake_server = FakePetPointServer(settings['port'], latency=settings['latency'],
+                                     error_rate=settings['error_rate'], session_expiry=settings['session_expiry'],
+                                     accept_replayed_state=settings['accept_replayed_state'])
+    logging.info('Serving fake PetPoint at {0}'.format(fake_server.url_template))
+    fake_server.serve_forever()
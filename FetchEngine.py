@@ -0,0 +1,223 @@
+import logging
+import re
+import time
+import urlparse
+
+import requests
+from lxml import html
+from requests.adapters import HTTPAdapter
+
+###########################
+# Fetch Engine
+###########################
+# All PetPoint requests go through requests.Session objects shared by the workers. Each session owns one urllib3
+# connection pool, so connections are kept alive and reused across ANums and every response is requested with gzip
+# transfer encoding (requests decompresses transparently). No worker builds its own mechanize.Browser.
+
+user_agent = "Mozilla/5.0 (X11; U; Linux i686; en-US; rv:1.9.2.13) Gecko/20101206 Ubuntu/10.10 (maverick) " \
+             "Firefox/3.6.13"
+postback_button = "ctl00$cphSearchArea$btnPostBackButton"
+sign_in_marker = 'Please sign in to continue'
+animal_number_regex = re.compile(r'id="cphWorkArea_lblAnimalNumber"[^>]*>\s*([^<]*?)\s*<')
+max_shortcut_failures = 3
+section_cookie_path = '/sms3/embeddedreports'
+
+
+class AuthenticationError(Exception):
+    pass
+
+
+class ControlNotFoundError(Exception):
+    pass
+
+
+class SessionExpiredError(Exception):
+    pass
+
+
+# Any response can come back as the login page once the server drops the session
+def check_signed_in(page, url):
+    if sign_in_marker in page:
+        raise SessionExpiredError('Session expired while loading {0}.'.format(url))
+    return page
+
+
+# Issue a request, waiting on the optional throttle first; HTTP error statuses raise like mechanize did.
+# With metrics, the request time is recorded under phase along with the bytes received on the wire.
+def request(session, method, url, throttle=None, timeout=None, phase=None, metrics=None, **kwargs):
+    if throttle is not None:
+        throttle()
+    request_start = time.time()
+    response = session.request(method, url, timeout=timeout, **kwargs)
+    if metrics is not None:
+        metrics.observe(phase or method.lower(), time.time() - request_start)
+        metrics.increment('bytes_received', int(response.headers.get('Content-Length') or len(response.content)))
+        metrics.increment('requests')
+    response.raise_for_status()
+    return response
+
+
+# Postback form values captured from one record page. Replaying them against another ANum's URL returns that record
+# fully expanded in a single request. After max_shortcut_failures misses in a row the shortcut is given up on.
+class FormState(object):
+    def __init__(self):
+        self.values = None
+        self.failures = 0
+
+    def usable(self):
+        return self.values is not None and self.failures < max_shortcut_failures
+
+
+def create_session(pool_size=10):
+    session = requests.Session()
+    session.headers.update({"User-agent": user_agent,
+                            "Accept-Encoding": "gzip, deflate",
+                            "Connection": "keep-alive"})
+    # pool_block keeps the number of open sockets at pool_size no matter how many workers share the session
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# Collect the values a browser would submit for the first form on the page, clicking the named submit control
+def get_form_submission(page, base_url, button=None):
+    tree = html.fromstring(page, base_url=base_url)
+    if len(tree.forms) == 0:
+        raise ControlNotFoundError('No form found on {0}.'.format(base_url))
+    form = tree.forms[0]
+    values = form.form_values()
+    if button is None:
+        # Mirror mechanize's default click of the first submit control
+        submits = form.xpath('.//input[@type="submit"]')
+    else:
+        submits = form.xpath('.//input[@name=$name]', name=button)
+        if len(submits) == 0:
+            raise ControlNotFoundError('Control {0} not found on {1}.'.format(button, base_url))
+    if len(submits) > 0 and submits[0].get('name') is not None:
+        values.append((submits[0].get('name'), submits[0].get('value', '')))
+    return form.action or base_url, values
+
+
+def authenticate(session, url_template, payload, timeout=None, metrics=None):
+    # Load a page to generate the login prompt
+    response = request(session, 'GET', url_template.strip() + '000000000', timeout=timeout, phase='login',
+                       metrics=metrics)
+    action, values = get_form_submission(response.content, response.url)
+    # Login with the user provided credentials
+    values = [(key, value) for (key, value) in values if key not in payload] + payload.items()
+    # submitting the login credentials
+    tmp = request(session, 'POST', action, data=values, timeout=timeout, phase='login', metrics=metrics).content
+    if sign_in_marker in tmp:
+        raise AuthenticationError('Authentication failed due to bad credentials.')
+    return session
+
+
+# Per-request section cookies for a profile: the listed sections are expanded by setting their cookies to 'block' and
+# every other section is collapsed.
+# Sent with each request instead of stored on the session, so workers sharing a session can use different profiles.
+def get_section_cookies(all_sections, enabled_sections):
+    enabled_sections = set(enabled_sections)
+    return dict((c, 'block' if c in enabled_sections else 'none') for c in all_sections)
+
+
+# Section cookies for one request, scoped to the report path so they replace any session cookie of the same name
+# instead of being sent alongside it
+def section_cookie_jar(url, section_cookies):
+    jar = requests.cookies.RequestsCookieJar()
+    domain = urlparse.urlparse(url).hostname
+    for name, value in section_cookies.items():
+        jar.set(name, value, domain=domain, path=section_cookie_path)
+    return jar
+
+
+# A replayed postback only counts if the server rendered the animal that was asked for. The page echoes the requested
+# AnimalID in its form action whatever it rendered, so only the animal number label is checked.
+def is_expected_record(page, a_number):
+    match = animal_number_regex.search(page)
+    return match is not None and match.group(1) == 'A' + a_number
+
+
+def fetch_record(session, url_template, a_number, throttle=None, timeout=None, form_state=None, metrics=None,
+                 section_cookies=None):
+    url = url_template.strip() + a_number
+    if section_cookies is not None:
+        section_cookies = section_cookie_jar(url, section_cookies)
+    if form_state is not None and form_state.usable():
+        # Single round trip: post the captured form state straight to this ANum's page
+        try:
+            response = request(session, 'POST', url, data=form_state.values, throttle=throttle, timeout=timeout,
+                               phase='single', metrics=metrics, cookies=section_cookies)
+            page = check_signed_in(response.content, url)
+            if is_expected_record(page, a_number):
+                form_state.failures = 0
+                return page
+        except requests.HTTPError:
+            pass
+        form_state.failures += 1
+        logging.debug('Single request fetch of {0} failed. Falling back to open and postback.'.format(a_number))
+    # Open the URL for a given anum
+    response = request(session, 'GET', url, throttle=throttle, timeout=timeout, phase='open', metrics=metrics,
+                       cookies=section_cookies)
+    check_signed_in(response.content, url)
+    # Reload the page through the postback button so the expanded sections are rendered
+    action, values = get_form_submission(response.content, response.url, button=postback_button)
+    response = request(session, 'POST', action, data=values, throttle=throttle, timeout=timeout, phase='postback',
+                       metrics=metrics, cookies=section_cookies)
+    page = check_signed_in(response.content, url)
+    if form_state is not None and form_state.values is None:
+        form_state.values = values
+    return page
+
+
+# Fetches records through a SessionPool and a ConcurrencyController: each fetch holds an in-flight slot, reports its
+# latency and outcome to the controller, and logs its session back in once if the server has signed it out.
+class RecordFetcher(object):
+    def __init__(self, session_pool, controller, url_template, timeout=None, single_round_trip=True, metrics=None):
+        self.session_pool = session_pool
+        self.metrics = metrics
+        self.controller = controller
+        self.url_template = url_template
+        self.timeout = timeout
+        self.single_round_trip = single_round_trip
+
+    def fetch(self, a_number, section_cookies=None):
+        entry = self.session_pool.acquire()
+        generation = entry.generation
+        try:
+            return self.fetch_with_entry(a_number, entry, section_cookies)
+        except SessionExpiredError:
+            entry = self.session_pool.renew(entry, generation)
+            return self.fetch_with_entry(a_number, entry, section_cookies)
+
+    def fetch_with_entry(self, a_number, entry, section_cookies=None):
+        form_state = None
+        if self.single_round_trip:
+            form_state = entry.state.setdefault('form', FormState())
+        self.controller.acquire()
+        fetch_start = time.time()
+        succeeded = False
+        timed_out = False
+        # Time spent waiting on the requests per second ceiling is not server latency; counting it would make the
+        # controller back off from its own rate limit
+        throttled = [0.0]
+
+        def throttle():
+            throttle_start = time.time()
+            self.controller.throttle()
+            throttled[0] += time.time() - throttle_start
+        try:
+            result = fetch_record(entry.session, self.url_template, a_number, throttle=throttle,
+                                  timeout=self.timeout, form_state=form_state, metrics=self.metrics,
+                                  section_cookies=section_cookies)
+            succeeded = True
+            return result
+        except requests.Timeout:
+            timed_out = True
+            raise
+        except (SessionExpiredError, ControlNotFoundError):
+            # The server answered; these say nothing about load
+            succeeded = True
+            raise
+        finally:
+            self.controller.release(time.time() - fetch_start - throttled[0], succeeded=succeeded, timed_out=timed_out)
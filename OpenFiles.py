@@ -1,12 +1,22 @@
 import logging
 import os
 import time
-import re
+import webbrowser
+
+import PageStore
+import RuleEngine
+from ReviewServer import DecisionLog, ReviewQueue, ReviewServer
 
 settings = {
     'directory': 'data',
+    'store': 'directory',  # Must match the store the crawler wrote with ('directory' or 'pack')
     'input_filename': 'blacklist.txt',
-    'concurrency': None,  # This script often runs faster w/o concurrency due the database and proc requirements
+    'port': 8765,  # Local port of the review server; 0 picks a free one
+    'prefetch': 10,  # Records ahead of the current one whose snippets are built in the background
+    'prefetch_workers': 2,
+    'review_keywords': ['parvo', 'distemper', 'panleuk'],  # Shown with the surrounding text in each snippet
+    'snippet_context': 80,  # Characters of text either side of a keyword
+    'decisions': 'review_decisions.tsv',  # Accept/reject decisions; a restarted review resumes where it stopped
     'log_level': 'INFO'
 }
 ###########################
@@ -44,13 +54,22 @@ if len(a_nums) == 0:
     logging.error('No ANums provided. Exiting.')
     exit()
 
-for anum in a_nums:
-    anum_file_string = 'A{0}'.format(anum)
-    file_path = os.path.join(os.path.dirname(__file__), settings['directory'], anum_file_string + '.htm').replace("/", "\\")
-    if not os.path.exists(file_path):
-        logging.info("{0} skipped because file does not exist.".format(anum))
-        continue
-    os.system("start " + file_path)
-    i = raw_input()
-    if i == 'q':
-        break
+store = PageStore.open_store(settings, os.path.join(os.path.dirname(__file__), settings['directory']))
+
+decisions = DecisionLog(os.path.join(os.path.dirname(__file__), settings['decisions']))
+review = ReviewQueue(store, a_nums, RuleEngine.RuleEngine(RuleEngine.keyword_rules(settings['review_keywords'])),
+                     decisions, prefetch=settings['prefetch'], workers=settings['prefetch_workers'],
+                     context=settings['snippet_context'])
+review.prefetch_after(review.next_undecided() - 1)
+server = ReviewServer(settings['port'], review)
+logging.info('Reviewing {0} ANum(s) at {1} ({2} already decided). Press Ctrl+C to stop.'.format(
+    len(a_nums), server.url, len(decisions.decisions)))
+webbrowser.open(server.url)
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+server.server_close()
+decisions.close()
+store.close()
+logging.info('Decisions are saved in {0}.'.format(decisions.path))
@@ -0,0 +1,51 @@
+import PageStore
+import RuleEngine
+
+###########################
+# Page Classification
+###########################
+# Decides whether a raw record page belongs on the whitelist. Shared by DataFilter.py and the crawler's streaming mode.
+# The first rule that fires gives the reason; add keywords or rules here to whitelist more diseases.
+parvo_test_regex = "<td>\s*Parvo Test \(IDEXX\)</td><td>.*</td><td>Positive</td>"
+whitelist_rules = [
+    RuleEngine.rule('location tags', 'containing non-case-sensitive location tags',
+                    keywords=['Parvo-Dog', 'Parvo Ward']),
+    RuleEngine.rule('parvo treatment', 'containing \'parvo treatment\' non-case-sensitive',
+                    keywords=['parvo treatment']),
+    RuleEngine.rule('parvo test', 'containing parvo positive test regex, case-sensitive', regex=parvo_test_regex)
+]
+whitelist_engine = RuleEngine.RuleEngine(whitelist_rules)
+# Cached classifications are only reused while this matches; bump rules_revision when the engine's logic changes
+rules_revision = 2
+rules_version = '{0}-{1}'.format(rules_revision, whitelist_engine.version)
+
+
+# Returns the reason the page is whitelisted, or None if it fails all tests
+def classify_page(text):
+    fired = whitelist_engine.first_match(text)
+    return fired.reason if fired is not None else None
+
+
+# Returns (anum, missing, reason) for a page in the store
+def classify_stored_page(store, a_number):
+    page = store.read(a_number)
+    if page is None:
+        return a_number, True, None
+    return a_number, False, classify_page(page)
+
+
+###########################
+# Process Pool Workers
+###########################
+# Each worker process opens its own store; DataFilter.py maps classify_in_worker over the ANums with Pool.imap so
+# results come back in input order.
+worker_store = None
+
+
+def init_worker(store_settings, directory):
+    global worker_store
+    worker_store = PageStore.open_store(store_settings, directory)
+
+
+def classify_in_worker(a_number):
+    return classify_stored_page(worker_store, a_number)
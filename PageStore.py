@@ -0,0 +1,229 @@
+import glob
+import logging
+import mmap
+import os
+import threading
+import zlib
+from contextlib import contextmanager
+
+from CrawlJournal import atomic_write, checksum
+
+###########################
+# Raw Page Stores
+###########################
+# Every script reads and writes raw record pages through one of these stores, keyed by ANum (without the leading A).
+# DirectoryStore is the original layout of one A########.htm file per animal. PackStore appends zlib compressed
+# pages to a few large pack files plus an append-only index and reads them back through mmap.
+
+
+class ChecksumMismatchError(Exception):
+    pass
+
+
+def page_name(a_number):
+    return 'A' + a_number + '.htm'
+
+
+def index_name(writer_id):
+    return 'index.tsv' if writer_id is None else 'index-{0}.tsv'.format(writer_id)
+
+
+def index_writer(path):
+    name = os.path.basename(path)
+    return None if name == 'index.tsv' else name[len('index-'):-len('.tsv')]
+
+
+def pack_name(writer_id, pack_number):
+    if writer_id is None:
+        return 'pack-{0:04d}.dat'.format(pack_number)
+    return 'pack-{0}-{1:04d}.dat'.format(writer_id, pack_number)
+
+
+class DirectoryStore(object):
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def path(self, a_number):
+        return os.path.join(self.directory, page_name(a_number))
+
+    def contains(self, a_number):
+        return os.path.exists(self.path(a_number))
+
+    def read(self, a_number):
+        if not self.contains(a_number):
+            return None
+        with open(self.path(a_number), 'rb') as page_file:
+            return page_file.read()
+
+    # Changes whenever the page is rewritten; None if it is missing
+    def fingerprint(self, a_number):
+        try:
+            stat = os.stat(self.path(a_number))
+        except OSError:
+            return None
+        return '{0}-{1:.6f}'.format(stat.st_size, stat.st_mtime)
+
+    # sha1 of the page content, or None if it is missing
+    def checksum(self, a_number):
+        with self.mapped(a_number) as page:
+            return checksum(page) if page is not None else None
+
+    # The page as a read-only mmap, or None if it is missing; the map is closed on exit
+    @contextmanager
+    def mapped(self, a_number):
+        if not self.contains(a_number):
+            yield None
+            return
+        with open(self.path(a_number), 'rb') as page_file:
+            if os.fstat(page_file.fileno()).st_size == 0:
+                yield ''  # mmap cannot map an empty file
+                return
+            page_map = mmap.mmap(page_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield page_map
+        finally:
+            page_map.close()
+
+    # Returns the raw size and sha1 of the page, as recorded in the crawl journal
+    def write(self, a_number, data):
+        return atomic_write(self.path(a_number), data)
+
+    def anums(self):
+        return [name[1:-4] for name in os.listdir(self.directory) if name.startswith('A') and name.endswith('.htm')]
+
+    def close(self):
+        pass
+
+
+# Several processes may share one pack directory (sharded crawls): each writer_id appends only to its own packs and
+# index (pack-<writer>-0000.dat, index-<writer>.tsv), so no two processes ever append to the same file. Every index in
+# the directory is read on open, oldest first so the most recently written copy of a page wins.
+class PackStore(object):
+    def __init__(self, directory, pack_size=256 * 1024 * 1024, compression_level=6, writer_id=None):
+        self.directory = directory
+        self.pack_size = pack_size
+        self.compression_level = compression_level
+        self.writer_id = writer_id
+        self.lock = threading.Lock()
+        self.index = {}  # anum -> (pack file name, offset, compressed length, raw length, sha1)
+        self.maps = {}
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        index_path = os.path.join(directory, index_name(writer_id))
+        needs_newline = False
+        index_paths = glob.glob(os.path.join(directory, 'index*.tsv'))
+        for path in sorted(index_paths, key=lambda path: (os.path.getmtime(path), path)):
+            truncated = self.load_index(path, index_writer(path))
+            if path == index_path:
+                needs_newline = truncated
+        self.index_file = open(index_path, 'ab')
+        if needs_newline:
+            self.index_file.write('\n')
+        # Always append to the newest pack
+        self.pack_number = 0
+        while os.path.exists(self.pack_path(self.pack_number + 1)):
+            self.pack_number += 1
+        self.pack_file = open(self.pack_path(self.pack_number), 'ab')
+        self.pack_file.seek(0, os.SEEK_END)
+        logging.debug('Opened pack store {0} with {1} page(s).'.format(directory, len(self.index)))
+
+    # Returns True if the last line was cut short by a crash
+    def load_index(self, path, writer_id):
+        needs_newline = False
+        with open(path, 'rb') as index_file:
+            for line in index_file:
+                fields = line.rstrip('\r\n').split('\t')
+                if len(fields) != 6 or not line.endswith('\n'):
+                    # An index line cut short by a crash points at a record that was never completed
+                    needs_newline = not line.endswith('\n')
+                    continue
+                self.index[fields[0]] = (pack_name(writer_id, int(fields[1])), int(fields[2]), int(fields[3]),
+                                         int(fields[4]), fields[5])
+        return needs_newline
+
+    def pack_path(self, pack_number):
+        return os.path.join(self.directory, pack_name(self.writer_id, pack_number))
+
+    def contains(self, a_number):
+        return a_number in self.index
+
+    def get_map(self, pack_file_name, end):
+        page_map = self.maps.get(pack_file_name)
+        if page_map is None or len(page_map) < end:
+            with self.lock:
+                if pack_file_name == pack_name(self.writer_id, self.pack_number):
+                    self.pack_file.flush()
+                with open(os.path.join(self.directory, pack_file_name), 'rb') as pack_file:
+                    page_map = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps[pack_file_name] = page_map
+        return page_map
+
+    # Raises ChecksumMismatchError if the page does not match the sha1 it was indexed with
+    def read(self, a_number):
+        location = self.index.get(a_number)
+        if location is None:
+            return None
+        pack_file_name, offset, length = location[0], location[1], location[2]
+        page_map = self.get_map(pack_file_name, offset + length)
+        try:
+            data = zlib.decompress(page_map[offset:offset + length])
+        except zlib.error:
+            data = None
+        if data is None or checksum(data) != location[4]:
+            raise ChecksumMismatchError('Page A{0} in {1} does not match its index entry.'.format(
+                a_number, pack_file_name))
+        return data
+
+    # The sha1 recorded in the index when the page was packed
+    def fingerprint(self, a_number):
+        location = self.index.get(a_number)
+        return location[4] if location is not None else None
+
+    # Packed pages are indexed by content, so the checksum is the fingerprint
+    def checksum(self, a_number):
+        return self.fingerprint(a_number)
+
+    # The record is flushed to its pack before its index line is written, so a crash never indexes a partial record
+    def write(self, a_number, data):
+        compressed = zlib.compress(data, self.compression_level)
+        digest = checksum(data)
+        with self.lock:
+            if self.pack_file.tell() > 0 and self.pack_file.tell() + len(compressed) > self.pack_size:
+                self.pack_file.close()
+                self.pack_number += 1
+                self.pack_file = open(self.pack_path(self.pack_number), 'ab')
+            offset = self.pack_file.tell()
+            self.pack_file.write(compressed)
+            self.pack_file.flush()
+            os.fsync(self.pack_file.fileno())
+            location = (self.pack_number, offset, len(compressed), len(data), digest)
+            self.index_file.write('\t'.join(str(field) for field in (a_number,) + location) + '\n')
+            self.index_file.flush()
+            self.index[a_number] = (pack_name(self.writer_id, self.pack_number),) + location[1:]
+        return len(data), digest
+
+    def anums(self):
+        return self.index.keys()
+
+    def close(self):
+        with self.lock:
+            for page_map in self.maps.values():
+                page_map.close()
+            self.maps = {}
+            self.pack_file.close()
+            self.index_file.close()
+
+
+# Pick the store named by settings['store'] ('directory' by default, or 'pack') rooted at directory. Processes that
+# write to the same directory at once must each pass their own writer_id.
+def open_store(settings, directory, writer_id=None):
+    store_type = 'directory'
+    if 'store' in settings and settings['store']:
+        store_type = settings['store'].strip().lower()
+    if store_type == 'pack':
+        return PackStore(directory, writer_id=writer_id)
+    if store_type != 'directory':
+        logging.warning('Unknown store type {0}. Using a plain directory.'.format(store_type))
+    return DirectoryStore(directory)
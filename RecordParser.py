@@ -0,0 +1,467 @@
+import logging
+import re
+import traceback
+from io import BytesIO
+# noinspection PyUnresolvedReferences
+import _strptime
+from lxml import etree
+
+import DateParsing
+import PageStore
+import TableClassifier
+from CrawlJournal import checksum
+
+###########################
+# Record Parsing
+###########################
+# Turns one raw record page into the nested record dictionary stored in the database. Parser.py runs this over pages
+# from the store; the crawler's streaming mode runs it on pages straight off the wire.
+text_content = etree.XPath('string()')  # What lxml.html's text_content() evaluates
+
+
+# One streaming pass over the page building a frame per table in document order. As the parse specifications expect,
+# a table's rows are every tr under it and a row's cells every td under it, nested tables included: a tr is added to
+# every open table and a td to every open row, in the order they start, and is filled in once the td ends. Cells are
+# freed once the outermost one has been read.
+def get_frames(page):
+    if isinstance(page, unicode):
+        page = page.encode('utf-8')
+    frames = []
+    open_frames = []
+    open_rows = []  # Per open tr, its row in each table that was open when it started
+    open_cells = []  # [(row, index)] slots each open td fills
+    for event, element in etree.iterparse(BytesIO(page), events=('start', 'end'), html=True):
+        tag = element.tag
+        if event == 'start':
+            if tag == 'table':
+                open_frames.append([])
+                frames.append(open_frames[-1])
+            elif tag == 'tr':
+                rows = [[] for _ in open_frames]  # This row as seen by each open table
+                for frame, row in zip(open_frames, rows):
+                    frame.append(row)
+                open_rows.append(rows)
+            elif tag == 'td':
+                slots = []
+                for rows in open_rows:
+                    for row in rows:
+                        slots.append((row, len(row)))
+                        row.append(None)
+                open_cells.append(slots)
+        elif tag == 'td':
+            contents = unicode(text_content(element).strip())
+            for row, index in open_cells.pop():
+                row[index] = contents
+            if not open_cells:
+                element.clear(keep_tail=True)
+        elif tag == 'tr':
+            open_rows.pop()
+        elif tag == 'table':
+            open_frames.pop()
+    return frames
+
+
+class FieldPlan(object):
+    def __init__(self, specification, debug_label=''):
+        self.constant = None  # Set when the specification itself is invalid; returned on every call
+        # Validate input specification shape
+        if (not isinstance(specification, type([]))) or len(specification) != 4:
+            logging.debug('Error in {1}. Parse specification {0} is either of incorrect type (expected []) '
+                          'or length (expected 4). Returning empty string pair.'.format(specification, debug_label))
+            self.constant = ('', '')
+            return
+        label, location, regex, postprocess = specification
+        # Validate label
+        if not isinstance(label, type('')):
+            logging.debug('Error in {1}. The provided label for specification {0} is not a valid string. '
+                          'Returning empty string pair.'.format(specification, debug_label))
+            self.constant = ('', '')
+            return
+        self.label = label.strip()
+        self.location = tuple(location)
+        self.specification = specification
+        # Validate regex and compile if necessary
+        if isinstance(regex, type('')):
+            try:
+                regex = re.compile(regex)
+            except:
+                logging.debug('Error in {1}. The provided regular expression for specification {0} is not valid. '
+                              'Returning labelled empty string.'.format(specification, debug_label))
+                self.constant = (self.label, '')
+                return
+        self.search = regex.search
+        self.postprocess = postprocess
+
+    # Returns (label, value) for the element at this plan's location in data
+    # noinspection PyBroadException
+    def extract(self, data, debug_label=''):
+        if self.constant is not None:
+            return self.constant
+        # Locate the data
+        result = data
+        try:
+            for key in self.location:
+                result = result[key]
+        except IndexError:
+            logging.debug('Error in {1}. The provided location does not exist for {0}. '
+                          'Returning empty string.'.format(self.specification, debug_label))
+            return self.label, ''
+        except:
+            logging.debug('Error in {1}. There was an unknown problem during location grabbing for {0}. '
+                          'Returning labelled empty string.'.format(self.specification, debug_label))
+            return self.label, ''
+        # Match the regex and strip final string result
+        try:
+            regex_match = self.search(result)
+        except:
+            logging.debug('Error in {1}. There was a problem matching regex for {0}. '
+                          'Returning labelled empty string.'.format(self.specification, debug_label))
+            return self.label, ''
+        if regex_match is None:
+            logging.debug('Error in {1}. No match found for {0} (string=\'{2}\'). '
+                          'Returning labelled empty string.'.format(self.specification, debug_label, result))
+            return self.label, ''
+        result = regex_match.group(0).strip()
+        # Postprocess the string
+        try:
+            result = self.postprocess(result)
+        except:
+            logging.debug('Error in {1}. There was a problem post-processing for specification {0}. '
+                          'Returning raw regex match (string=\'{2}\').'.format(self.specification, debug_label,
+                                                                                 result))
+        return self.label, result
+
+
+class TablePlan(object):
+    def __init__(self, table_specification, debug_label=''):
+        self.fields = [FieldPlan(specification, debug_label) for specification in table_specification]
+
+    def extract(self, data, debug_label=''):
+        result = {}
+        for field in self.fields:
+            label, value = field.extract(data, debug_label)
+            result[label] = value
+        return result
+
+
+# Row fields are located relative to each row, so rows need no copied or rewritten specifications
+class SubtablePlan(object):
+    def __init__(self, label, table_number, row_specification, skip_first=True):
+        self.label = label
+        self.table_number = table_number
+        self.row_plan = TablePlan(row_specification, label)
+        self.skip_first = skip_first
+
+    def extract(self, frames, debug_label=''):
+        table = frames[self.table_number]
+        if not table:
+            return {self.label: ''}
+        subtable_data = []
+        for row_num, row in enumerate(table):
+            if self.skip_first and row_num == 0:
+                continue
+            element = self.row_plan.extract(row, debug_label)
+            if not all(value == '' for value in element.values()):
+                subtable_data.append(element)
+        return {self.label: subtable_data}
+
+
+def parse_element(data, specification, debug_label=''):
+    label, value = FieldPlan(specification, debug_label).extract(data, debug_label)
+    return {label: value}
+
+
+def generate_table_dictionary(data, table_specification, debug_label=''):
+    return TablePlan(table_specification, debug_label).extract(data, debug_label)
+
+
+def generate_flexible_subtable(label, data, iter_table_number, subtable_specification, debug_label='', skip_first=True):
+    return SubtablePlan(label, iter_table_number, subtable_specification, skip_first).extract(data, debug_label)
+
+
+def parse_issue_date(text):
+    return DateParsing.parse_timestamp(text.replace('Issue Date:', '').strip())
+
+
+###########################
+# Extraction Plans
+###########################
+# Parse specifications are [label, location, regex, postprocess]. They are compiled once, at import, into plans with
+# compiled regexes and resolved locations; parsing a record only runs the plans.
+record_fields = [  # key, frame_loc, regex, postprocess
+    # Table 1
+    ['anum', [1, 0, 0], "(?!:\s*)[Aa]\d{8}", lambda x: x],
+    ['print_date', [1, 1, 0], "(?!:\s*)\d.*M", DateParsing.parse_timestamp],
+    # Table 2
+    ['confirmation_anum', [2, 0, 0], "(?!:\s*)[Aa]\d{8}", lambda x: x],
+    ['alt_id', [2, 1, 0], ".*", lambda x: x],
+    ['gender', [2, 2, 1], "([Mm]ale)|([Ff]emale)|([Uu]nknown)", lambda x: x.lower()],
+    ['age_range', [2, 3, 1], ".*", lambda x: x.replace('no longer in use', '').strip()],
+    ['name', [2, 0, 1], ".*", lambda x: x.strip()],
+    ['declawed', [2, 2, 2], "(?=Declawed:).*", lambda x: x.split(':')[1].strip()],
+    ['bite_history', [2, 3, 2], "(?=Bitten:).*", lambda x: x.split(':')[1].strip()],
+    ['physical_attributes', [2, 0, 2], ".*", lambda x: [y.strip() for y in x.split(',')]],
+    ['species', [2, 1, 1], "([Dd]og)|([Cc]at)|([Uu]nknown)", lambda x: x.lower()],
+    ['age', [2, 1, 2], "^.*(?=\s+\,\s+)", lambda x: x],
+    ['dob', [2, 1, 2], "\d+\/\d+\/\d+", DateParsing.parse_date],
+    ['spay_neuter', [2, 1, 2], "(?=Spayed/Neutered:).*", lambda x: x.split(':')[1].strip()],
+
+    ['featured_pet', [14, 1, 0], ".*", lambda x: x.strip()],
+    ['adoption_price', [14, 1, 1], ".*", lambda x: x.strip()],
+    ['houstrained', [14, 1, 2], ".*", lambda x: x.strip()],
+    ['houstraining_comments', [14, 1, 3], ".*", lambda x: x.strip()],
+    ['special_needs', [14, 3, 0], ".*", lambda x: x.strip()],
+    ['special_needs_comments', [14, 5, 0], ".*", lambda x: x.strip()],
+    ['behavioral_special_needs', [14, 3, 1], ".*", lambda x: x.strip()],
+    ['medical_special_needs', [14, 3, 2], ".*", lambda x: x.strip()],
+    ['historical_environment', [14, 3, 3], ".*", lambda x: x.strip()],
+    ['recommended_environment', [14, 3, 4], ".*", lambda x: x.strip()],
+    ['service_animal', [14, 3, 5], ".*", lambda x: x.strip()],
+
+    ['veterinarian', [14, 7, 0], ".*", lambda x: x.strip()],
+    ['allergies', [14, 7, 1], ".*", lambda x: x.strip()],
+    ['medications', [14, 7, 2], ".*", lambda x: x.strip()],
+
+    ['i_enjoy', [14, 16, 0], ".*", lambda x: x.strip()],
+    ['i_am_afraid_of', [14, 16, 1], ".*", lambda x: x.strip()],
+    ['people_describe_me_as', [14, 16, 2], ".*", lambda x: x.strip()],
+
+    ['activity_level', [14, 18, 0], ".*", lambda x: x.strip()],
+    ['vocalization_level', [14, 18, 1], ".*", lambda x: x.strip()],
+    ['off_leash', [14, 18, 2], ".*", lambda x: x.strip()],
+    ['training_history', [14, 18, 3], ".*", lambda x: x.strip()],
+
+    ['specific_known_commands', [14, 20, 0], ".*", lambda x: x.strip()],
+    ['animal_profile_comments', [14, 22, 0], ".*", lambda x: x.strip()]
+]
+
+# (label, frame number, row fields); the first row of each table is its heading
+subtable_specifications = [
+    ('animal_point_in_time', 3, [
+        ['event_date', [0], ".*", DateParsing.parse_timestamp],
+        ['data_source', [0], "(?!\n).*$", lambda x: x.strip()],
+        ['size_bcs', [1], ".*", lambda x: x.strip()],
+        ['animal_condition_asilomar', [2], ".*", lambda x: x.strip()],
+        ['medical_status_age_group', [3], ".*", lambda x: x.replace('no longer in use', '').strip()],
+        ['temp_status_weight', [4], ".*", lambda x: x.strip()],
+        ['bitten_danger', [5], ".*", lambda x: x.strip()],
+        ['s_n_pulse', [6], ".*", lambda x: x.strip()],
+        ['temp_resp', [7], ".*", lambda x: x.strip()]
+    ]),
+    # Ownership/guardian
+    ('ownership', 4, [
+        ['person_id', [0], ".*", lambda x: x.strip()],
+        ['date_from', [1], ".*", DateParsing.parse_date],
+        ['person_name', [2], ".*", lambda x: x.strip()],
+        ['phone', [3], ".*", lambda x: x.strip()],
+        ['address', [4], ".*", lambda x: x.strip()],
+        ['city', [5], ".*", lambda x: x.strip()],
+        ['completed_by', [6], ".*", lambda x: x.strip()]
+    ]),
+    # stage
+    ('stage', 5, [
+        ['stage', [0], ".*", lambda x: x.strip()],
+        ['from', [1], ".*", DateParsing.parse_timestamp],
+        ['review_date', [2], ".*", DateParsing.parse_timestamp],
+        ['by', [3], ".*", lambda x: x.strip()],
+        ['stage_change_reason', [4], ".*", lambda x: x.strip()]
+    ]),
+    # location
+    ('location', 6, [
+        ['location', [0], ".*", lambda x: x.strip()],
+        ['sublocation', [1], ".*", lambda x: x.strip()],
+        ['from', [2], ".*", DateParsing.parse_timestamp],
+        ['by', [3], ".*", lambda x: x.strip()]
+    ]),
+    # microchip number
+    ('microchip', 7, [
+        ['number', [0], ".*", lambda x: x.strip()],
+        ['provider', [1], ".*", lambda x: x.strip()],
+        ['issue_date', [2], ".*", DateParsing.parse_timestamp]
+    ]),
+    # medical record
+    ('medical_record', 8, [
+        ['record_number', [0], ".*", lambda x: x.strip()],
+        ['type', [1], ".*", lambda x: x.strip()],
+        ['subtype', [2], ".*", lambda x: x.strip()],
+        ['medical_status', [3], ".*", lambda x: x.strip()],
+        ['temperament_status', [4], ".*", lambda x: x.strip()],
+        ['date', [5], ".*", DateParsing.parse_timestamp],
+        ['review_date', [6], ".*", DateParsing.parse_timestamp]
+    ]),
+    # conditions
+    ('conditions', 9, [
+        ['condition', [0], ".*", lambda x: x.strip()],
+        ['type', [1], ".*", lambda x: x.strip()],
+        ['date', [2], ".*", DateParsing.parse_timestamp],
+        ['body_part', [3], ".*", lambda x: x.strip()],
+        ['resolution_date', [4], ".*", DateParsing.parse_timestamp],
+        ['review_date', [5], ".*", DateParsing.parse_timestamp],
+        ['record_number', [6], ".*", lambda x: x.strip()]
+    ]),
+    # tests
+    ('tests', 10, [
+        ['type', [0], ".*", lambda x: x.strip()],
+        ['for_condition', [1], ".*", lambda x: x.strip()],
+        ['result', [2], ".*", lambda x: x.strip()],
+        ['date', [3], ".*", DateParsing.parse_timestamp],
+        ['result_date', [4], ".*", DateParsing.parse_timestamp],
+        ['re-test_date', [5], ".*", DateParsing.parse_timestamp],
+        ['record_number', [6], ".*", lambda x: x.strip()]
+    ]),
+    # vaccinations
+    ('vaccinations', 11, [
+        ['vaccination', [0], ".*", lambda x: x.strip()],
+        ['type', [1], ".*", lambda x: x.strip()],
+        ['date', [2], ".*", DateParsing.parse_timestamp],
+        ['re-vacc_date', [3], ".*", DateParsing.parse_timestamp],
+        ['pet_id', [4], ".*", lambda x: x.strip()],
+        ['pet_id_type', [5], ".*", lambda x: x.strip()],
+        ['record_number', [6], ".*", lambda x: x.strip()]
+    ]),
+    # treatments
+    ('treatments', 12, [
+        ['treatment', [0], ".*", lambda x: x.strip()],
+        ['type', [1], ".*", lambda x: x.strip()],
+        ['dose', [2], ".*", lambda x: x.strip()],
+        ['for', [3], ".*", lambda x: x.strip()],
+        ['date', [4], ".*", DateParsing.parse_timestamp],
+        ['review_date', [5], ".*", DateParsing.parse_timestamp],
+        ['record_number', [6], ".*", lambda x: x.strip()]
+    ]),
+    # memo
+    ('memo', 13, [
+        ['type', [0], ".*", lambda x: x.strip()],
+        ['subtype', [1], ".*", lambda x: x.strip()],
+        ['date', [2], ".*", DateParsing.parse_timestamp],
+        ['comment', [3], ".*", lambda x: x.strip()],
+        ['by', [4], ".*", lambda x: x.strip()],
+        ['review_date', [5], ".*", DateParsing.parse_timestamp]
+    ]),
+    # animals
+    ('animals', 15, [
+        ['quantity', [0], ".*", lambda x: x.strip()],
+        ['animal_type', [1], ".*", lambda x: x.strip()],
+        ['lived_with', [2], ".*", lambda x: x.strip()],
+        ['interacted_with', [3], ".*", lambda x: x.strip()],
+        ['tested_with', [4], ".*", lambda x: x.strip()],
+        ['do_not_place', [5], ".*", lambda x: x.strip()]
+    ]),
+    # people
+    ('people', 16, [
+        ['quantity', [0], ".*", lambda x: x.strip()],
+        ['age_groups', [1], ".*", lambda x: x.strip()],
+        ['lived_with', [2], ".*", lambda x: x.strip()],
+        ['interacted_with', [3], ".*", lambda x: x.strip()],
+        ['tested_with', [4], ".*", lambda x: x.strip()],
+        ['do_not_place', [5], ".*", lambda x: x.strip()]
+    ])
+]
+
+
+# TODO: Update with correct field names/locations
+outcome_fields = [
+    ['date', [0, 0], ".*", DateParsing.parse_timestamp],
+    ['outcome_type', [0, 1], ".*", lambda x: x.strip()],
+    ['record_owner', [0, 2], "Record Owner:.*\,", lambda x: x.replace('Record Owner:', '').strip()],
+    ['released', [0, 2], "Released:\s*\S*", lambda x: x.replace('Released:', '').strip()],
+    ['outcome_created_date', [0, 2], "Created Date:.*", lambda x: x.replace('Created Date:', '').strip()],
+    ['status', [1, 0], ".*", lambda x: x.strip()],
+    ['location', [1, 1], ".*", lambda x: x.strip()],
+    ['p_num', [2, 1], ".*", lambda x: x.strip()],
+    ['contact', [2, 2], ".*", lambda x: x.strip()],
+    ['subtype', [5, 2], "^.*\,", lambda x: x.replace(',', '').strip()],
+    ['issue_date', [5, 2], "Issue Date:.*[AaPp]M", parse_issue_date]
+]
+
+# TODO: Update with correct field names/locations
+intake_fields = [
+    ['date', [1, 0], ".*", DateParsing.parse_timestamp],
+    ['intake_type', [1, 1], ".*", lambda x: x.strip()],
+    ['record_owner', [1, 2], "Record Owner:.*\,", lambda x: x.replace('Record Owner:', '').strip()],
+    ['status', [2, 0], "Status:.*\,", lambda x: x.replace('Status:', '').replace(',', '').strip()],
+    ['source_raw', [2, 1], ".*", lambda x: x.strip()],
+    ['source', [2, 2], "Source:.*", lambda x: x.replace('Source:', '').strip()],
+    ['reason', [2, 2], "Reason:.*", lambda x: x.replace('Reason:', '').strip()],
+    ['p_num', [4, 1], ".*", lambda x: x.strip()],
+    ['contact', [4, 2], ".*", lambda x: x.strip()],
+    ['subcontact', [5, 2], ".*", lambda x: x.strip()]
+]
+
+record_plan = TablePlan(record_fields)
+subtable_plans = [SubtablePlan(label, table_number, fields) for label, table_number, fields in subtable_specifications]
+outcome_plan = TablePlan(outcome_fields)
+intake_plan = TablePlan(intake_fields)
+
+
+# Identifies a postprocessor by its code, so editing a lambda changes the parser version
+def describe_postprocess(postprocess):
+    code = getattr(postprocess, '__code__', None) or getattr(getattr(postprocess, 'parse', None), '__code__', None)
+    if code is None:
+        return repr(postprocess)
+    return code.co_code + repr(code.co_consts) + repr(code.co_names)
+
+
+# Stored with each record's page checksum so incremental parses redo every page when parsing changes. It covers the
+# specifications and table roles; bump parser_revision for changes they do not show.
+parser_revision = 1
+parser_version = '{0}-{1}'.format(parser_revision, checksum(repr([
+    [(field[0], field[1], field[2], describe_postprocess(field[3])) for field in fields]
+    for fields in [record_fields, outcome_fields, intake_fields] + [spec[2] for spec in subtable_specifications]] +
+    [TableClassifier.table_roles]))[:12])
+
+
+# Identifies what a stored record was parsed from and how, for incremental parsing
+def fingerprint(page_checksum):
+    return '{0}:{1}'.format(page_checksum, parser_version)
+
+
+def parse_record(a_number, page):
+    frames = get_frames(page)
+    # Validate Shapes
+    expected_shapes = [None, (2L,), (4L, 3L), (None, 8L), None]
+    for frame, shape in zip(frames, expected_shapes):
+        TableClassifier.validate_shape(frame, shape)
+    frames = TableClassifier.associate_frames(frames)
+
+    result = {}
+    for subtable_plan in subtable_plans:
+        result.update(subtable_plan.extract(frames, debug_label=a_number))
+    result.update({'outcomes': [{"outcome": outcome_plan.extract(outcome, debug_label=a_number)}
+                                for outcome in frames[17]]})
+    result.update({'intakes': [{"intake": intake_plan.extract(intake, debug_label=a_number)}
+                               for intake in frames[18]]})
+    result.update(record_plan.extract(frames, debug_label=a_number))
+    if not result['anum']:
+        result['anum'] = 'A' + a_number  # Records are keyed by ANum in the database
+    return result
+
+
+###########################
+# Process Pool Workers
+###########################
+# Each worker process opens its own store and parses a batch of ANums per task, so Parser.py's writer receives
+# finished records in batches and in input order. Errors are returned rather than raised so one bad page does not
+# lose the rest of its batch.
+worker_store = None
+
+
+def init_worker(store_settings, directory):
+    global worker_store
+    worker_store = PageStore.open_store(store_settings, directory)
+
+
+# Returns [(anum, record or None if the page is missing, fingerprint of the page read, error text or None)]
+# noinspection PyBroadException
+def parse_batch(a_numbers):
+    results = []
+    for a_number in a_numbers:
+        try:
+            page = worker_store.read(a_number)
+            if page is None:
+                results.append((a_number, None, None, None))
+            else:
+                results.append((a_number, parse_record(a_number, page), fingerprint(checksum(page)), None))
+        except Exception:
+            results.append((a_number, None, None, traceback.format_exc()))
+    return results
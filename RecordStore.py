@@ -0,0 +1,239 @@
+import calendar
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+import DateParsing
+import RecordParser
+
+###########################
+# SQLite Record Store
+###########################
+# Parsed records in normalized SQLite tables instead of one nested TinyDB document per animal. The schema follows
+# RecordParser's specifications: one animals row per record holding its scalar fields, one table per subtable
+# (stage, location, tests, treatments, memo, ...) and intakes/outcomes tables, with a row per entry keyed by
+# (anum, position). Datetimes are stored as UTC-naive epoch seconds so date ranges can use the indexes; values a
+# postprocessor could not parse stay text. Inserts are buffered and written batch_size records per transaction, and
+# inserting an ANum again replaces its earlier record. An optional fingerprint of the page a record was parsed from is
+# kept beside it for incremental parsing.
+animals_table = 'animals'
+# Subtables whose label would clash with another table
+table_names = {'animals': 'animal_companions'}
+json_columns = ('physical_attributes',)  # Fields holding lists
+# Postprocessors that return datetimes; a field using one of them is a date column
+date_parsers = (DateParsing.parse_timestamp, DateParsing.parse_date, RecordParser.parse_issue_date)
+
+
+def quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def field_labels(specification):
+    labels = []
+    for field in specification:
+        if field[0].strip() not in labels:
+            labels.append(field[0].strip())
+    return labels
+
+
+# Every date field of a specification, stored as epoch seconds and decoded back to datetimes on export
+def date_columns(specification):
+    return set(field[0].strip() for field in specification if field[3] in date_parsers)
+
+
+# The first date field of a specification, indexed for date range queries
+def event_column(specification):
+    for field in specification:
+        if field[3] in date_parsers:
+            return field[0].strip()
+    return None
+
+
+# (record key, table name, field specification, wrapper key inside each list entry or None)
+child_tables = [(label, table_names.get(label, label), fields, None)
+                for label, _, fields in RecordParser.subtable_specifications]
+child_tables += [('outcomes', 'outcomes', RecordParser.outcome_fields, 'outcome'),
+                 ('intakes', 'intakes', RecordParser.intake_fields, 'intake')]
+animal_columns = [label for label in field_labels(RecordParser.record_fields) if label != 'anum']
+
+
+def encode(value):
+    if isinstance(value, datetime):
+        return calendar.timegm(value.timetuple()) + value.microsecond / 1e6
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    return value
+
+
+def decode(column, value):
+    if isinstance(value, float):
+        return datetime.utcfromtimestamp(value)
+    if column in json_columns and isinstance(value, basestring) and value.startswith('['):
+        return json.loads(value)
+    return value
+
+
+class RecordStore(object):
+    def __init__(self, path, batch_size=500):
+        self.path = path
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.pending = []
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.create_schema()
+
+    def create_schema(self):
+        columns = ''.join(', {0}'.format(quote(column)) for column in animal_columns)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS {0} (anum TEXT PRIMARY KEY{1}, missing_sections TEXT)'
+                                .format(animals_table, columns))
+        self.connection.execute('CREATE TABLE IF NOT EXISTS fingerprints (anum TEXT PRIMARY KEY, fingerprint TEXT)')
+        for _, table, fields, _ in child_tables:
+            columns = ''.join(', {0}'.format(quote(column)) for column in field_labels(fields))
+            self.connection.execute('CREATE TABLE IF NOT EXISTS {0} (anum TEXT NOT NULL, position INTEGER NOT NULL'
+                                    '{1}, PRIMARY KEY (anum, position))'.format(quote(table), columns))
+            date_column = event_column(fields)
+            if date_column is not None:
+                self.connection.execute('CREATE INDEX IF NOT EXISTS {0} ON {1} ({2})'.format(
+                    quote(table + '_' + date_column), quote(table), quote(date_column)))
+
+    # Buffered; written once batch_size records are pending or on flush()/close()
+    def insert(self, record, fingerprint=None):
+        self.insert_multiple([record], [fingerprint])
+
+    def insert_multiple(self, records, fingerprints=None):
+        with self.lock:
+            self.pending.extend(zip(records, fingerprints or [None] * len(records)))
+            if len(self.pending) < self.batch_size:
+                return
+            batch, self.pending = self.pending, []
+        self.write(batch)
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if batch:
+            self.write(batch)
+
+    def write(self, records):
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                for record, fingerprint in records:
+                    self.write_record(cursor, record, fingerprint)
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+        logging.debug('Wrote {0} record(s) to {1}.'.format(len(records), self.path))
+
+    def write_record(self, cursor, record, fingerprint=None):
+        a_number = record.get('anum')
+        if not a_number:
+            logging.warning('Skipping a record without an ANum.')
+            return
+        self.delete_rows(cursor, a_number)
+        if fingerprint is not None:
+            cursor.execute('INSERT INTO fingerprints (anum, fingerprint) VALUES (?, ?)', (a_number, fingerprint))
+        missing = [label for label, _, _, _ in child_tables if record.get(label) == '']
+        cursor.execute('INSERT INTO {0} (anum, {1}, missing_sections) VALUES (?{2}, ?)'.format(
+            animals_table, ', '.join(quote(column) for column in animal_columns), ', ?' * len(animal_columns)),
+            [a_number] + [encode(record.get(column, '')) for column in animal_columns] + [','.join(missing)])
+        for label, table, fields, wrapper in child_tables:
+            rows = record.get(label)
+            if not isinstance(rows, list) or not rows:
+                continue
+            columns = field_labels(fields)
+            cursor.executemany('INSERT INTO {0} (anum, position, {1}) VALUES (?, ?{2})'.format(
+                quote(table), ', '.join(quote(column) for column in columns), ', ?' * len(columns)),
+                ([a_number, position] + [encode((row[wrapper] if wrapper else row).get(column, ''))
+                                         for column in columns] for position, row in enumerate(rows)))
+
+    def delete_rows(self, cursor, a_number):
+        cursor.execute('DELETE FROM fingerprints WHERE anum = ?', (a_number,))
+        cursor.execute('DELETE FROM {0} WHERE anum = ?'.format(animals_table), (a_number,))
+        for _, table, _, _ in child_tables:
+            cursor.execute('DELETE FROM {0} WHERE anum = ?'.format(quote(table)), (a_number,))
+
+    # Removes the records (and fingerprints) of the ANums in one transaction
+    def delete(self, a_numbers):
+        self.flush()
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                for a_number in a_numbers:
+                    self.delete_rows(cursor, a_number)
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+
+    # anum -> fingerprint of the page each record was parsed from, for records inserted with one
+    def fingerprints(self):
+        return dict(self.query('SELECT anum, fingerprint FROM fingerprints'))
+
+    def query(self, sql, parameters=()):
+        self.flush()
+        with self.lock:
+            return self.connection.execute(sql, [encode(p) for p in parameters]).fetchall()
+
+    def count(self):
+        return self.query('SELECT COUNT(*) FROM {0}'.format(animals_table))[0][0]
+
+    def __len__(self):
+        return self.count()
+
+    # The nested record as RecordParser produced it, or None
+    def get(self, a_number):
+        records = self.read_records('WHERE anum = ?', (a_number,))
+        return records[0] if records else None
+
+    def all(self):
+        return self.read_records()
+
+    def read_records(self, where='', parameters=()):
+        self.flush()
+        with self.lock:
+            cursor = self.connection.execute('SELECT * FROM {0} {1} ORDER BY anum'.format(animals_table, where),
+                                             parameters)
+            names = [description[0] for description in cursor.description]
+            records = []
+            by_anum = {}
+            for row in cursor:
+                record = dict((name, decode(name, value)) for name, value in zip(names, row))
+                missing = record.pop('missing_sections') or ''
+                for label, _, _, _ in child_tables:
+                    record[label] = '' if label in missing.split(',') else []
+                records.append(record)
+                by_anum[record['anum']] = record
+            for label, table, _, wrapper in child_tables:
+                cursor = self.connection.execute('SELECT * FROM {0} {1} ORDER BY anum, position'.format(
+                    quote(table), where), parameters)
+                names = [description[0] for description in cursor.description]
+                for row in cursor:
+                    values = dict((name, decode(name, value)) for name, value in zip(names, row))
+                    record = by_anum.get(values.pop('anum'))
+                    if record is None:
+                        continue
+                    values.pop('position')
+                    record[label].append({wrapper: values} if wrapper else values)
+        return records
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.connection.close()
+
+
+# Start a fresh database, as Parser.py does for a full rebuild
+def recreate(path, batch_size=500):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    return RecordStore(path, batch_size)
@@ -0,0 +1,94 @@
+import collections
+import logging
+import time
+from datetime import datetime, timedelta
+
+import CrawlJournal
+import DateParsing
+import RecordStore
+
+###########################
+# Re-crawl Scheduling
+###########################
+# Decides which ANums are due for another fetch from the age of their last fetch (the crawl journal) and the state of
+# their parsed record. Every record falls in one class with its own refetch interval in days (None = never refetch):
+#   active  - no final outcome and a stage or location change within active_window days
+#   open    - no final outcome yet
+#   final   - the latest outcome is at or after the latest intake
+#   unknown - fetched but never parsed (e.g. skipped by the keyword filter)
+# ANums that were never fetched, or whose last fetch failed, are always due.
+default_intervals = {'active': 0.25, 'open': 1, 'unknown': 7, 'final': None}
+
+RecordState = collections.namedtuple('RecordState', ['has_final_outcome', 'last_change'])
+
+
+# Dates come back from the database as datetimes, the UTC epoch seconds RecordStore stores them as, or text a date
+# parser gave up on
+def as_datetime(value):
+    if isinstance(value, (int, long, float)):
+        return RecordStore.decode('date', float(value))
+    return DateParsing.parse_any(value)
+
+
+def latest(values):
+    dates = [d for d in (as_datetime(v) for v in values) if d is not None]
+    return max(dates) if dates else None
+
+
+# Map unprefixed ANum -> RecordState for every parsed record, computed with one aggregate query per table
+def query_record_states(record_store):
+    def latest_by_anum(table, column):
+        rows = record_store.query('SELECT anum, MAX("{1}") FROM "{0}" WHERE typeof("{1}") = \'real\' '
+                                  'GROUP BY anum'.format(table, column))
+        dates = dict((a_number, RecordStore.decode(column, value)) for a_number, value in rows)
+        # Text a date parser gave up on may still be a date in another format
+        for a_number, value in record_store.query('SELECT anum, "{1}" FROM "{0}" WHERE typeof("{1}") = \'text\' '
+                                                  'AND "{1}" != \'\''.format(table, column)):
+            dates[a_number] = latest([dates.get(a_number), value])
+        return dates
+    last_intakes = latest_by_anum('intakes', 'date')
+    last_outcomes = latest_by_anum('outcomes', 'date')
+    last_stages = latest_by_anum('stage', 'from')
+    last_locations = latest_by_anum('location', 'from')
+    states = {}
+    for (a_number,) in record_store.query('SELECT anum FROM animals'):
+        last_intake, last_outcome = last_intakes.get(a_number), last_outcomes.get(a_number)
+        has_final_outcome = last_outcome is not None and (last_intake is None or last_outcome >= last_intake)
+        states[a_number.lstrip('Aa')] = RecordState(has_final_outcome, latest(
+            [last_stages.get(a_number), last_locations.get(a_number)]))
+    return states
+
+
+class RecrawlScheduler(object):
+    def __init__(self, journal, record_states, intervals=None, active_window=14):
+        self.journal = journal
+        self.record_states = record_states
+        self.intervals = dict(default_intervals)
+        if intervals:
+            self.intervals.update(intervals)
+        self.active_window = timedelta(days=active_window)
+
+    def classify(self, a_number, now):
+        state = self.record_states.get(a_number)
+        if state is None:
+            return 'unknown'
+        if state.has_final_outcome:
+            return 'final'
+        if state.last_change is not None and now - state.last_change <= self.active_window:
+            return 'active'
+        return 'open'
+
+    def is_due(self, a_number, now=None):
+        entry = self.journal.get(a_number)
+        if entry is None or entry.status not in CrawlJournal.finished_statuses:
+            return True
+        interval = self.intervals.get(self.classify(a_number, now or datetime.now()))
+        if interval is None:
+            return False
+        return time.time() - entry.timestamp >= interval * 24 * 60 * 60
+
+    def due(self, a_numbers):
+        now = datetime.now()
+        result = [a for a in a_numbers if self.is_due(a, now)]
+        logging.info('{0} of {1} ANum(s) are due for a re-crawl.'.format(len(result), len(a_numbers)))
+        return result
@@ -0,0 +1,58 @@
+import logging
+import os
+import random
+import threading
+import time
+
+
+###########################
+# Retries
+###########################
+# Exponential backoff with jitter: attempt n waits between half and all of min(max_delay, base_delay * 2^n) seconds,
+# so workers that failed together during an outage do not all come back at the same moment.
+class RetryPolicy(object):
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=60.0, on_retry=None):
+        self.on_retry = on_retry  # Called with the label before each retry
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        ceiling = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return ceiling / 2.0 + random.uniform(0, ceiling / 2.0)
+
+    # Call function until it returns, re-raising the last exception once max_attempts is used up
+    def run(self, function, label, *args):
+        for attempt in range(self.max_attempts):
+            try:
+                return function(*args)
+            except Exception as e:
+                if attempt + 1 >= self.max_attempts:
+                    raise
+                wait = self.delay(attempt)
+                logging.warning('Attempt {0}/{1} for {2} failed ({3}). Retrying in {4:.1f}s.'.format(
+                    attempt + 1, self.max_attempts, label, repr(e), wait))
+                if self.on_retry is not None:
+                    self.on_retry(label)
+                time.sleep(wait)
+
+
+# ANums that failed every attempt, written in the same newline separated A# format the crawler reads as input.
+# The file is replaced by the first failure of a run, so it can be fed back in as the input file of the next run.
+# Processes running at the same time need a path each, or one would truncate the others' entries.
+class DeadLetterFile(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def add(self, a_number):
+        with self.lock:
+            with open(self.path, 'a' if self.count > 0 else 'w') as dead_letter_file:
+                dead_letter_file.write('A' + a_number + '\n')
+            self.count += 1
+
+    def report(self):
+        if self.count > 0:
+            logging.warning('{0} ANum(s) failed every attempt and were written to {1}. Use it as the input file to '
+                            'retry them.'.format(self.count, os.path.abspath(self.path)))
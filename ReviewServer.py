@@ -0,0 +1,276 @@
+import BaseHTTPServer
+import Queue
+import SocketServer
+import cgi
+import json
+import logging
+import os
+import re
+import threading
+import time
+import urlparse
+
+from lxml import html
+
+
+###########################
+# Record Review Server
+###########################
+# Serves a queue of record pages for manual review in one browser tab. Each record is reduced to a compact snippet:
+# the text around every review keyword, the rows of its Tests tables and the rows of its Location tables. Snippets for
+# the next records are built by background threads while the current one is on screen, so stepping forward does not
+# wait on the store or the HTML parser. Accept/reject decisions are appended to a TSV file (anum, decision, timestamp);
+# the last line for an ANum wins and a restarted review resumes at the first undecided record.
+ACCEPT = 'accept'
+REJECT = 'reject'
+decisions_allowed = (ACCEPT, REJECT)
+whitespace_regex = re.compile(r'\s+')
+
+
+def clean_text(text):
+    return whitespace_regex.sub(' ', text).strip()
+
+
+# Rows of every table whose first row starts with one of the headings
+def table_rows(tree, headings):
+    rows = []
+    for table in tree.iterfind('.//table'):
+        table_rows_found = table.findall('.//tr')
+        if not table_rows_found:
+            continue
+        first_row = clean_text(table_rows_found[0].text_content())
+        if not any(first_row.startswith(heading) for heading in headings):
+            continue
+        for row in table_rows_found[1:]:
+            cells = [clean_text(cell.text_content()) for cell in row.iterfind('.//td')]
+            if any(cells):
+                rows.append(cells)
+    return rows
+
+
+def build_snippet(a_number, page, keyword_engine, context=80, max_matches=20):
+    tree = html.fromstring(page)
+    text = clean_text(tree.text_content())
+    matches = []
+    covered_until = -1
+    for offset, keyword in keyword_engine.find_keyword_positions(text):
+        if offset < covered_until:
+            continue  # Already inside the previous snippet
+        start, end = max(0, offset - context), offset + len(keyword) + context
+        matches.append({'keyword': keyword, 'before': text[start:offset],
+                        'match': text[offset:offset + len(keyword)], 'after': text[offset + len(keyword):end]})
+        covered_until = end
+        if len(matches) >= max_matches:
+            break
+    return {'anum': a_number,
+            'size': len(page),
+            'matches': matches,
+            'tests': table_rows(tree, ('Tests',)),
+            'locations': table_rows(tree, ('Location',))}
+
+
+class DecisionLog(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.decisions = {}
+        if os.path.exists(path):
+            with open(path, 'rb') as decision_file:
+                for line in decision_file:
+                    fields = line.rstrip('\r\n').split('\t')
+                    if len(fields) == 3 and line.endswith('\n') and fields[1] in decisions_allowed:
+                        self.decisions[fields[0]] = fields[1]
+        self.decision_file = open(path, 'ab')
+
+    def record(self, a_number, decision):
+        with self.lock:
+            self.decision_file.write('{0}\t{1}\t{2:.3f}\n'.format(a_number, decision, time.time()))
+            self.decision_file.flush()
+            self.decisions[a_number] = decision
+
+    def get(self, a_number):
+        return self.decisions.get(a_number)
+
+    def close(self):
+        with self.lock:
+            self.decision_file.close()
+
+
+class ReviewQueue(object):
+    def __init__(self, store, a_numbers, keyword_engine, decisions, prefetch=10, workers=2, context=80):
+        self.store = store
+        self.a_numbers = a_numbers
+        self.keyword_engine = keyword_engine
+        self.decisions = decisions
+        self.prefetch = prefetch
+        self.context = context
+        self.snippets = {}  # index -> snippet, or None for a missing page
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.work = Queue.Queue()
+        for _ in range(max(1, workers)):
+            t = threading.Thread(target=self.build_snippets)
+            t.daemon = True
+            t.start()
+
+    def build_snippets(self):
+        while True:
+            index = self.work.get()
+            # noinspection PyBroadException
+            try:
+                self.snippet(index)
+            except Exception:
+                logging.exception('Could not build the review snippet for A{0}.'.format(self.a_numbers[index]))
+            finally:
+                with self.lock:
+                    self.pending.discard(index)
+
+    def snippet(self, index):
+        with self.lock:
+            if index in self.snippets:
+                return self.snippets[index]
+        a_number = self.a_numbers[index]
+        page = self.store.read(a_number)
+        snippet = None
+        if page is not None:
+            snippet = build_snippet(a_number, page, self.keyword_engine, self.context)
+        with self.lock:
+            self.snippets[index] = snippet
+        return snippet
+
+    # Queue the records after index so they are ready before the reviewer steps to them
+    def prefetch_after(self, index):
+        with self.lock:
+            for ahead in range(index + 1, min(len(self.a_numbers), index + 1 + self.prefetch)):
+                if ahead not in self.snippets and ahead not in self.pending:
+                    self.pending.add(ahead)
+                    self.work.put(ahead)
+
+    def next_undecided(self, start=0):
+        for index in range(start, len(self.a_numbers)):
+            if self.decisions.get(self.a_numbers[index]) is None:
+                return index
+        return len(self.a_numbers)
+
+
+review_page = u'''<html><head><meta charset="utf-8"><title>Review {position}</title>
+<link rel="prefetch" href="/review?i={next}">
+<style>body{{font-family:sans-serif;margin:2em}} .match{{background:#ff0}} td{{padding:0 .6em;border-bottom:1px solid #ddd}}
+.accept{{color:#070}} .reject{{color:#a00}}</style></head><body>
+<h2>{anum} <small>({position} of {total}, {decided} decided) {decision}</small></h2>
+<form method="post" action="/decide">
+<input type="hidden" name="i" value="{index}">
+<button name="decision" value="accept" accesskey="a">Accept (a)</button>
+<button name="decision" value="reject" accesskey="r">Reject (r)</button>
+<a href="/review?i={previous}">Previous (p)</a> <a href="/review?i={next}">Next (n)</a>
+<a href="/page/{anum_digits}" target="_blank">Full page (f)</a>
+</form>
+<h3>Keyword context</h3>{matches}<h3>Tests</h3>{tests}<h3>Locations</h3>{locations}
+<script>document.onkeydown=function(e){{var k={{a:'accept',r:'reject'}}[e.key];
+if(k){{document.querySelector('button[value='+k+']').click();}}
+else if(e.key=='n'){{location='/review?i={next}';}}else if(e.key=='p'){{location='/review?i={previous}';}}
+else if(e.key=='f'){{window.open('/page/{anum_digits}');}}}};</script>
+</body></html>'''
+
+
+def render_rows(rows):
+    if not rows:
+        return u'<p>None</p>'
+    return u'<table>' + u''.join(u'<tr>' + u''.join(u'<td>{0}</td>'.format(cgi.escape(cell)) for cell in row) +
+                                u'</tr>' for row in rows) + u'</table>'
+
+
+def render_review(review, index):
+    a_number = review.a_numbers[index]
+    snippet = review.snippet(index)
+    review.prefetch_after(index)
+    if snippet is None:
+        matches = u'<p>Page not found in the store.</p>'
+        tests = locations = u''
+    else:
+        matches = u''.join(u'<p>&hellip;{0}<span class="match">{1}</span>{2}&hellip;</p>'.format(
+            cgi.escape(m['before']), cgi.escape(m['match']), cgi.escape(m['after'])) for m in snippet['matches'])
+        matches = matches or u'<p>No review keywords found.</p>'
+        tests, locations = render_rows(snippet['tests']), render_rows(snippet['locations'])
+    decision = review.decisions.get(a_number)
+    return review_page.format(anum='A' + a_number, anum_digits=a_number, index=index, position=index + 1,
+                              total=len(review.a_numbers), decided=len(review.decisions.decisions),
+                              decision=u'<span class="{0}">{0}ed</span>'.format(decision) if decision else u'',
+                              previous=max(0, index - 1), next=min(len(review.a_numbers) - 1, index + 1),
+                              matches=matches, tests=tests, locations=locations)
+
+
+class ReviewHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format_string, *args):
+        logging.debug('Review: ' + format_string % args)
+
+    def do_GET(self):
+        review = self.server.review
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        if url.path == '/':
+            return self.redirect('/review?i={0}'.format(review.next_undecided()))
+        if url.path == '/review':
+            index = self.get_index(query)
+            if index is None:
+                return self.respond(404, 'No such record.', 'text/plain')
+            if index >= len(review.a_numbers):
+                return self.respond(200, 'Every record has been reviewed.', 'text/plain')
+            return self.respond(200, render_review(review, index).encode('utf-8'))
+        if url.path == '/snippet.json':
+            index = self.get_index(query)
+            if index is None or index >= len(review.a_numbers):
+                return self.respond(404, 'No such record.', 'text/plain')
+            return self.respond(200, json.dumps(review.snippet(index)), 'application/json')
+        if url.path.startswith('/page/'):
+            page = review.store.read(url.path[len('/page/'):])
+            if page is None:
+                return self.respond(404, 'No such page.', 'text/plain')
+            return self.respond(200, page)
+        return self.respond(404, 'Not found', 'text/plain')
+
+    def do_POST(self):
+        review = self.server.review
+        length = int(self.headers.getheader('content-length') or 0)
+        form = urlparse.parse_qs(self.rfile.read(length))
+        index = self.get_index(form)
+        decision = form.get('decision', [''])[0]
+        if self.path != '/decide' or index is None or index >= len(review.a_numbers) or \
+                decision not in decisions_allowed:
+            return self.respond(400, 'Bad decision.', 'text/plain')
+        review.decisions.record(review.a_numbers[index], decision)
+        logging.info('A{0} {1}ed.'.format(review.a_numbers[index], decision))
+        return self.redirect('/review?i={0}'.format(review.next_undecided(index + 1)))
+
+    def get_index(self, query):
+        try:
+            index = int(query.get('i', ['0'])[0])
+        except ValueError:
+            return None
+        return index if index >= 0 else None
+
+    def redirect(self, location):
+        self.send_response(303)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def respond(self, status, body, content_type='text/html; charset=utf-8'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ReviewServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, review):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), ReviewHandler)
+        self.review = review
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/'.format(self.server_address[1])
+
@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+import time
+
+import FakePetPoint
+import PageClassifier
+import PageStore
+import RuleEngine
+
+###########################
+# Settings
+###########################
+# Times the rule engine against the scans it replaced: the crawler's lower() plus 'in' per filter keyword and
+# DataFilter's lower() plus 'in' checks followed by the parvo test regex. Pages come from a page store, or are
+# synthetic FakePetPoint records padded to about page_size bytes.
+settings = {
+    'directory': None,  # Directory of a page store to read pages from; None for synthetic pages
+    'store': 'directory',
+    'pages': 20,
+    'page_size': 320 * 1024,
+    'keywords': ['parvo', 'distemper', 'ringworm', 'kennel cough', 'mange', 'giardia', 'coccidia', 'heartworm', 'fiv',
+                 'felv', 'panleukopenia', 'calicivirus'],
+    'keyword_counts': [1, 4, 12],  # Filter sizes to time, each the first n keywords
+    'repeat': 5,
+    'output': None,  # File name for machine readable results; None to skip
+    'log_level': 'INFO'
+}
+###########################
+# Setup Logging
+###########################
+if 'log_level' in settings:
+    level = settings['log_level'].strip()
+else:
+    level = 'WARNING'
+logging.basicConfig(level=logging.getLevelName(level), format='%(asctime)s, %(levelname)s: %(message)s')
+
+
+def synthetic_page(a_number, size):
+    sections = FakePetPoint.synthetic_sections(a_number, set(FakePetPoint.section_names))
+    while len(sections) < size:
+        sections += FakePetPoint.synthetic_sections(a_number + str(len(sections)), set(FakePetPoint.section_names))
+    return FakePetPoint.record_page.format(action='', anum=a_number, view_state='', event_validation='',
+                                          sections=sections)
+
+
+def load_pages():
+    if settings['directory']:
+        store = PageStore.open_store(settings, settings['directory'])
+        pages = [store.read(a_number) for a_number in sorted(store.anums())[:settings['pages']]]
+        store.close()
+        return pages
+    return [synthetic_page('{0:08d}'.format(30000000 + i), settings['page_size']) for i in range(settings['pages'])]
+
+
+# Mean milliseconds per page of the best of repeat passes
+def time_per_page(function, pages):
+    best = None
+    for _ in range(settings['repeat']):
+        pass_start = time.time()
+        for page in pages:
+            function(page)
+        elapsed = time.time() - pass_start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best / len(pages) * 1000, 3)
+
+
+def baseline_filter(keywords):
+    def scan(page):
+        return [keyword for keyword in keywords if keyword.lower() not in page.lower()]
+    return scan
+
+
+def baseline_classify(page):
+    search_text = page.lower()
+    if 'parvo-dog' in search_text or 'parvo ward' in search_text:
+        return 'location tags'
+    if 'parvo treatment' in search_text:
+        return 'parvo treatment'
+    if PageClassifier.whitelist_engine.regexes['parvo test'].search(page):
+        return 'parvo test'
+    return None
+
+
+###########################
+# Begin Benchmark
+###########################
+benchmark_pages = load_pages()
+logging.info('Timing {0} page(s) averaging {1} bytes.'.format(
+    len(benchmark_pages), sum(len(page) for page in benchmark_pages) // max(1, len(benchmark_pages))))
+results = [{'name': 'classify_page',
+            'baseline_ms': time_per_page(baseline_classify, benchmark_pages),
+            'engine_ms': time_per_page(PageClassifier.classify_page, benchmark_pages)}]
+for count in settings['keyword_counts']:
+    keywords = settings['keywords'][:count]
+    engine = RuleEngine.RuleEngine(RuleEngine.keyword_rules(keywords))
+    results.append({'name': 'filter {0} keyword(s)'.format(len(keywords)),
+                    'baseline_ms': time_per_page(baseline_filter(keywords), benchmark_pages),
+                    'engine_ms': time_per_page(engine.unmatched, benchmark_pages)})
+for result in results:
+    logging.info('{name}: {engine_ms} ms per page with the rule engine, {baseline_ms} ms before.'.format(**result))
+if settings['output']:
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), settings['output']), 'w') as out_file:
+        json.dump(results, out_file, indent=2)
@@ -0,0 +1,60 @@
+import collections
+import re
+
+from CrawlJournal import checksum
+
+###########################
+# Keyword Rule Engine
+###########################
+# Declarative page rules. A rule fires when the page contains any of its keywords (literal, case-insensitive) or when
+# its regex matches. The page is lowercased once and each keyword is a plain substring search of that copy, which runs
+# at C speed; a case-insensitive regex tried at every position was several times slower even for one keyword (see
+# RuleBenchmark.py). Regexes are only run for rules that no keyword has already decided.
+Rule = collections.namedtuple('Rule', ['name', 'reason', 'keywords', 'regex', 'regex_flags'])
+
+
+def rule(name, reason=None, keywords=(), regex=None, regex_flags=0):
+    return Rule(name, reason or name, tuple(keyword.strip().lower() for keyword in keywords), regex, regex_flags)
+
+
+# One rule per keyword, named after the keyword
+def keyword_rules(keywords):
+    return [rule(keyword.strip().lower(), keywords=[keyword]) for keyword in keywords]
+
+
+class RuleEngine(object):
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.keywords = sorted(set(keyword for r in self.rules for keyword in r.keywords if keyword))
+        self.regexes = dict((r.name, re.compile(r.regex, r.regex_flags)) for r in self.rules if r.regex)
+        self.version = checksum(repr(self.rules))[:12]
+
+    # (offset, keyword) for the longest keyword starting at each position where one does, in text order
+    def find_keyword_positions(self, text):
+        lowered_text = text.lower()
+        positions = {}
+        for keyword in self.keywords:
+            offset = lowered_text.find(keyword)
+            while offset != -1:
+                if len(keyword) > len(positions.get(offset, '')):
+                    positions[offset] = keyword
+                offset = lowered_text.find(keyword, offset + 1)
+        return sorted(positions.items())
+
+    def fires(self, r, text, lowered_text):
+        if any(keyword in lowered_text for keyword in r.keywords):
+            return True
+        return r.name in self.regexes and self.regexes[r.name].search(text) is not None
+
+    # The first rule, in rule order, that fires on the text, or None. Rules after it are never scanned for.
+    def first_match(self, text):
+        lowered_text = text.lower()
+        for r in self.rules:
+            if self.fires(r, text, lowered_text):
+                return r
+        return None
+
+    # Every rule that does not fire on the text, in rule order
+    def unmatched(self, text):
+        lowered_text = text.lower()
+        return [r for r in self.rules if not self.fires(r, text, lowered_text)]
@@ -0,0 +1,52 @@
+import itertools
+import logging
+import threading
+
+
+###########################
+# Session Pool
+###########################
+# Sessions are shared rather than checked out, so many workers can use one login. When a worker sees the sign in
+# page it renews only the session it was using; workers holding other sessions keep going, and workers that hit the
+# same expired session wait on that session's lock and then reuse the single fresh login.
+class PooledSession(object):
+    def __init__(self, index, session):
+        self.index = index
+        self.session = session
+        self.generation = 0
+        self.renewing = False
+        self.lock = threading.Lock()
+        # Anything tied to this login (such as captured form fields); discarded when the session is renewed
+        self.state = {}
+
+
+class SessionPool(object):
+    def __init__(self, size, create_session):
+        self.create_session = create_session
+        self.entries = [PooledSession(index, create_session()) for index in range(max(1, size))]
+        self.next_index = itertools.count()
+        logging.info('Session pool ready with {0} authenticated session(s).'.format(len(self.entries)))
+
+    # Hand out sessions round robin, skipping any that are currently logging in again if possible
+    def acquire(self):
+        for _ in range(len(self.entries)):
+            entry = self.entries[next(self.next_index) % len(self.entries)]
+            if not entry.renewing:
+                return entry
+        return self.entries[next(self.next_index) % len(self.entries)]
+
+    # Log in again for this entry only. generation is the value the caller saw when it acquired the entry; if another
+    # worker already renewed it in the meantime, the existing fresh session is reused instead of logging in again.
+    def renew(self, entry, generation):
+        with entry.lock:
+            if entry.generation != generation:
+                return entry
+            entry.renewing = True
+            try:
+                logging.warning('Session {0} expired. Re-authenticating.'.format(entry.index))
+                entry.session = self.create_session()
+                entry.state = {}
+                entry.generation += 1
+            finally:
+                entry.renewing = False
+        return entry
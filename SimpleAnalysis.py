@@ -1,65 +1,50 @@
-from tinydb import *  # This should probably be transitioned to sqlite3 at some point
 from datetime import datetime, timedelta
-import operator
 import itertools
 import matplotlib.pyplot as plt
 from matplotlib.dates import YearLocator, MonthLocator, DateFormatter
 
-db = TinyDB('db.json')
-animal = Query()
+from RecordStore import RecordStore
 
+db = RecordStore('records.sqlite')
 
-def get_unique_value_for_field(field, search=None):
-    q = Query()
-    if search is None:
-        return list(set([reduce(operator.getitem, field, item) for item in db.search(q.anum != '')]))
-    else:
-        return list(set([reduce(operator.getitem, field, item) for item in db.search(search)]))
 
+def get_unique_value_for_field(table, column, where='', parameters=()):
+    return [row[0] for row in db.query('SELECT DISTINCT "{1}" FROM "{0}" {2}'.format(table, column, where),
+                                       parameters)]
 
-def length_test(val, gt, lt):
-    return lt > len(val) > gt
 
+# ANums whose first intake falls in [start_date, end_date)
+def get_first_intakes_between(start_date, end_date):
+    return get_unique_value_for_field('intakes', 'anum', 'WHERE position = 0 AND date >= ? AND date < ?',
+                                      (start_date, end_date))
 
-def date_between(val, start_date, end_date):
-    return start_date <= datetime.fromtimestamp(val) < end_date
 
+def get_parvo_test_positive_anums():
+    return get_unique_value_for_field('tests', 'anum', "WHERE lower(type) LIKE '%parvo test (idexx)%' "
+                                                       "AND lower(result) LIKE '%positive%'")
 
-def contains_parvo_test_positive(tests_val):
-    for test in tests_val:
-        if "Parvo Test (IDEXX)".lower() in test['type'].lower() and "Positive".lower() in test['result'].lower():
-            return True
-    return False
 
-
-# print list(set([item['anum'] for item in db.search(animal.tests.test(contains_parvo_test_positive))]))
+# print get_parvo_test_positive_anums()
 
 print len(db)
-print db.count(animal.intakes[0].intake.intake_type == 'Transfer In')
-# print list(set([item['intakes'][0]['intake']['intake_type'] for item in db.search(animal.intakes[0].intake.intake_type != 'Transfer In')]))
-# print get_unique_value_for_field(['intakes', 0, 'intake', 'intake_type'])
-# print get_unique_value_for_field(['intakes', 1, 'intake', 'intake_type'], search=animal.intakes.test(length_test, 1, sys.maxint))
-# print get_unique_value_for_field(['outcomes', 1, 'outcome', 'outcome_type'], search=animal.intakes.test(length_test, 1, sys.maxint))
+print db.query('SELECT COUNT(*) FROM intakes WHERE position = 0 AND intake_type = ?', ('Transfer In',))[0][0]
+# print get_unique_value_for_field('intakes', 'intake_type', 'WHERE position = 0 AND intake_type != ?', ('Transfer In',))
+# print get_unique_value_for_field('intakes', 'intake_type', 'WHERE position = 0')
+# print get_unique_value_for_field('intakes', 'intake_type', 'WHERE position = 1')
+# print get_unique_value_for_field('outcomes', 'outcome_type', 'WHERE position = 1 AND anum IN (SELECT anum FROM intakes WHERE position = 1)')
 years = range(2007, 2018)
 dates = ['01/{0}/{1}'.format(month, year) for (year, month) in list(itertools.product(years, range(1, 13)))]
 
 for year in years:
     date0 = datetime.strptime('01/01/{0}'.format(year), '%d/%m/%Y')
     date1 = datetime.strptime('01/01/{0}'.format(year + 1), '%d/%m/%Y') - timedelta(seconds=1)
-    print '{0} to {1} : {2}'.format(date0, date1,
-                                    len(get_unique_value_for_field(['anum'],
-                                                                   search=animal.intakes[0].intake.date.test(
-                                                                       date_between, date0, date1))))
+    print '{0} to {1} : {2}'.format(date0, date1, len(get_first_intakes_between(date0, date1)))
 
 values = []
 for idx in range(len(dates) - 1):
     date0 = datetime.strptime(dates[idx], '%d/%m/%Y')
     date1 = datetime.strptime(dates[idx + 1], '%d/%m/%Y') - timedelta(seconds=1)
-    value = get_unique_value_for_field(['anum'], search=animal.intakes[0].intake.date.test(
-        date_between,
-        date0,
-        date1
-    ))
+    value = get_first_intakes_between(date0, date1)
     values.append(len(value))
     print '{0} to {1} : {2}'.format(date0, date1, len(value))
 
@@ -136,12 +121,6 @@ ax.grid(True)
 fig.autofmt_xdate()
 plt.show()
 '''
-'''for table in db.tables():
-    contents = db.table(table).all()
-
-    schema = Counter(frozenset(doc.keys()) for doc in contents)
-
-    print('table %s (documents %d):' % (table, sum(schema.values())))
-    for fields, count in schema.iteritems():
-        print('  document (count %d):' % count)
-        print('\n'.join('    %s' % field for field in fields))'''
+'''for (table,) in db.query("SELECT name FROM sqlite_master WHERE type = 'table'"):
+    print('table %s (rows %d):' % (table, db.query('SELECT COUNT(*) FROM "%s"' % table)[0][0]))
+    print('\n'.join('    %s' % column[1] for column in db.query('PRAGMA table_info("%s")' % table)))'''
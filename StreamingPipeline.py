@@ -0,0 +1,116 @@
+import Queue
+import collections
+import logging
+import threading
+import traceback
+from threading import Thread
+
+import PageClassifier
+import RecordParser
+
+
+###########################
+# Streaming Pipeline
+###########################
+# Carries fetched pages through the DataFilter classification and Parser record extraction in memory, so records
+# reach the database while the crawl is still running. Both queues are bounded: when parsing or writing falls behind,
+# submit() blocks the crawler threads instead of letting pages pile up in memory.
+# A page's on_done callback runs once its record has been committed (flush() returned after it was written) or once
+# the page was blacklisted, so a page that fails to parse or write is never reported as finished.
+class StreamingPipeline(object):
+    def __init__(self, write_record, workers=1, queue_size=100, flush=None, commit_size=500):
+        self.write_record = write_record
+        self.flush = flush
+        self.commit_size = commit_size
+        self.pages = Queue.Queue(queue_size)
+        self.records = Queue.Queue(queue_size)
+        self.counts = collections.Counter()
+        self.counts_lock = threading.Lock()
+        self.workers = [Thread(target=self.parse_pages) for _ in range(max(1, workers))]
+        self.writer = Thread(target=self.write_records)
+        for t in self.workers + [self.writer]:
+            t.daemon = True
+            t.start()
+
+    def count(self, key):
+        with self.counts_lock:
+            self.counts[key] += 1
+
+    def submit(self, a_number, page, on_done=None):
+        self.pages.put((a_number, page, on_done))
+
+    def parse_pages(self):
+        while True:
+            item = self.pages.get()
+            if item is None:
+                break
+            a_number, page, on_done = item
+            # noinspection PyBroadException
+            try:
+                reason = PageClassifier.classify_page(page)
+                if reason is None:
+                    logging.info('{0} blacklisted for failing all tests.'.format(a_number))
+                    self.count('blacklisted')
+                    if on_done is not None:
+                        on_done()
+                    continue
+                logging.info('{0} whitelisted for {1}.'.format(a_number, reason))
+                self.records.put((RecordParser.parse_record(a_number, page), on_done))
+                self.count('parsed')
+            except Exception:
+                logging.error('There was an error parsing the streamed anum, {0}.'.format(a_number))
+                logging.error(traceback.format_exc())
+                self.count('failed')
+
+    def write_records(self):
+        uncommitted = []  # on_done callbacks of records written but not yet flushed
+        while True:
+            item = self.records.get()
+            if item is None:
+                break
+            record, on_done = item
+            # noinspection PyBroadException
+            try:
+                self.write_record(record)
+                self.count('written')
+                uncommitted.append(on_done)
+            except Exception:
+                logging.error('Could not send {0} to DB.'.format(record.get('anum')))
+                logging.error(traceback.format_exc())
+                # A failed write may have taken the buffered batch with it
+                uncommitted = self.discard(uncommitted)
+            if uncommitted and (self.records.empty() or len(uncommitted) >= self.commit_size):
+                uncommitted = self.commit(uncommitted)
+        self.commit(uncommitted)
+
+    # Flush the database and report the records as done; returns what is still uncommitted
+    def commit(self, uncommitted):
+        # noinspection PyBroadException
+        try:
+            if self.flush is not None:
+                self.flush()
+        except Exception:
+            logging.error('Could not commit streamed records to DB.')
+            logging.error(traceback.format_exc())
+            return self.discard(uncommitted)
+        for on_done in uncommitted:
+            if on_done is not None:
+                on_done()
+        return []
+
+    def discard(self, uncommitted):
+        if uncommitted:
+            logging.error('{0} streamed record(s) were not committed and will be fetched again.'.format(
+                len(uncommitted)))
+        return []
+
+    # Drain everything already submitted, then stop the threads
+    def close(self):
+        for _ in self.workers:
+            self.pages.put(None)
+        for t in self.workers:
+            t.join()
+        self.records.put(None)
+        self.writer.join()
+        logging.info('Streaming pipeline finished: {0} parsed, {1} written, {2} blacklisted, {3} failed.'.format(
+            self.counts['parsed'], self.counts['written'], self.counts['blacklisted'], self.counts['failed']))
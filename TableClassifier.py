@@ -0,0 +1,107 @@
+import logging
+import re
+
+###########################
+# Table Classification
+###########################
+# Assigns each table (frame) of a record page to the role RecordParser reads it as, in one pass over the frames.
+# Roles are identified from a few header cells: headers that must equal a fixed label are looked up in a dictionary,
+# the rest are matched against patterns compiled once at import. A frame may fill more than one role.
+# (pattern, header cell location) in role order; RecordParser's specifications refer to roles by this index
+table_roles = [
+    ['^Animal Number:$', [0, 0]],
+    ['^Animal: (?!:\s*)[Aa]\d{8}$', [0, 0]],
+    ['^(?!:\s*)[Aa]\d{8}', [0, 0]],
+    ['^DateSource$', [0, 0]],
+    ['^PersonID$', [0, 0]],
+    ['^Stage$', [0, 0]],
+    ['^Location$', [0, 0]],
+    ['^Microchip Number$', [0, 0]],
+    ['^Medical Record #$', [0, 0]],
+    ['^Conditions$', [0, 0]],
+    ['^Tests$', [0, 0]],
+    ['^Vaccinations$', [0, 0]],
+    ['^Treatments$', [0, 0]],
+    ['^Type$', [0, 0]],
+    ['^Featured Pet$', [0, 0]],
+    ['^Animal Type', [0, 1]],
+    ['^Age Groups$', [0, 1]],
+    ['Outcome Created Date:', [0, 2]],
+    ['^Reason', [2, 2]]
+]
+list_roles = 2  # The last roles (outcomes and intakes) stay lists even when only one frame matches
+literal_regex = re.compile(r'^\^([\w :#]+)\$$')
+
+
+def compile_roles(roles):
+    exact = {}  # (row, column) -> {cell text: [role index]}
+    patterns = []  # (role index, row, column, compiled pattern)
+    for index, (pattern, location) in enumerate(roles):
+        literal = literal_regex.match(pattern)
+        if literal is not None:
+            exact.setdefault(tuple(location), {}).setdefault(literal.group(1), []).append(index)
+        else:
+            patterns.append((index, location[0], location[1], re.compile(pattern)))
+    return exact, patterns
+
+
+exact_roles, pattern_roles = compile_roles(table_roles)
+
+
+def header_cell(frame, row, column):
+    if row < len(frame) and column < len(frame[row]):
+        return frame[row][column]
+    return None
+
+
+# Returns one entry per role: None when no frame has the role, the frame when one does and a list of frames when
+# several do. The last list_roles roles are always lists.
+def associate_frames(frames):
+    frame_association = [[] for _ in table_roles]
+    for frame in frames:
+        if len(frame) == 0:
+            continue
+        matched = set()
+        for location, roles_by_text in exact_roles.items():
+            cell = header_cell(frame, location[0], location[1])
+            if cell is not None and cell in roles_by_text:
+                matched.update(roles_by_text[cell])
+        for index, row, column, pattern in pattern_roles:
+            cell = header_cell(frame, row, column)
+            if cell is not None and pattern.search(cell) is not None:
+                matched.add(index)
+        for index in matched:
+            frame_association[index].append(frame)
+    # Flatten single value and empty value elements except intake and outcome (last two in list)
+    for index in range(len(frame_association) - list_roles):
+        if len(frame_association[index]) == 0:
+            frame_association[index] = None
+        elif len(frame_association[index]) == 1:
+            frame_association[index] = frame_association[index][0]
+    return frame_association
+
+
+# Shape a NumPy array built from the frame would have: (rows, columns) when every row has the same number of cells,
+# otherwise (rows,)
+def frame_shape(frame):
+    if len(frame) > 0:
+        width = len(frame[0])
+        if all(len(row) == width for row in frame):
+            return len(frame), width
+    return len(frame),
+
+
+# expected_size may leave dimensions as None to accept any size
+def validate_shape(frame, expected_size):
+    if expected_size is None:
+        return True
+    shape = frame_shape(frame)
+    if None in expected_size:
+        result = all(shape_element == expected_element for (shape_element, expected_element)
+                     in zip(shape, expected_size) if expected_element is not None)
+    else:
+        result = shape == tuple(expected_size)
+    if not result:
+        logging.debug('Table has unexpected shape {0} (expected {1}).'.format(shape, expected_size))
+        return False
+    return True
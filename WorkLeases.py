@@ -0,0 +1,172 @@
+import Queue
+import collections
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+###########################
+# Lease-based Work Sharing
+###########################
+# Several crawler processes, on one host or on several hosts sharing a file system, pull ANums from one SQLite
+# database. A worker leases a batch for lease_seconds and keeps renewing the lease while it works through it. If a
+# worker dies its leases expire and the ANums are handed to the next worker that asks. Every process may add the same
+# input list; ANums already in the database are left as they are.
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def default_worker_id():
+    return '{0}-{1}'.format(socket.gethostname(), os.getpid())
+
+
+class LeaseStore(object):
+    def __init__(self, path, worker_id=None, lease_seconds=600):
+        self.path = path
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.lock = threading.Lock()
+        # Autocommit mode; every change runs in an explicit BEGIN IMMEDIATE transaction so only one process writes
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS work (anum TEXT PRIMARY KEY, state TEXT NOT NULL, '
+                                'owner TEXT, lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0, updated REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS work_state ON work (state, lease_expires)')
+        # Leases left by an earlier process with the same worker id will never be finished by it
+        self.transaction(lambda cursor: cursor.execute(
+            'UPDATE work SET state = ?, owner = NULL, lease_expires = NULL WHERE state = ? AND owner = ?',
+            (PENDING, LEASED, self.worker_id)))
+
+    def transaction(self, function, *args):
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                result = function(cursor, *args)
+                cursor.execute('COMMIT')
+                return result
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+
+    def add(self, a_numbers):
+        def insert(cursor):
+            now = time.time()
+            cursor.executemany('INSERT OR IGNORE INTO work (anum, state, updated) VALUES (?, ?, ?)',
+                               ((a, PENDING, now) for a in a_numbers))
+        self.transaction(insert)
+
+    # Lease up to size ANums that are pending or whose lease has expired
+    def lease_batch(self, size):
+        def lease(cursor):
+            now = time.time()
+            cursor.execute('SELECT anum FROM work WHERE state = ? OR (state = ? AND lease_expires < ?) '
+                           'ORDER BY anum LIMIT ?', (PENDING, LEASED, now, size))
+            a_numbers = [str(row[0]) for row in cursor.fetchall()]
+            cursor.executemany('UPDATE work SET state = ?, owner = ?, lease_expires = ?, attempts = attempts + 1, '
+                               'updated = ? WHERE anum = ?',
+                               ((LEASED, self.worker_id, now + self.lease_seconds, now, a) for a in a_numbers))
+            return a_numbers
+        return self.transaction(lease)
+
+    # Extend the leases this worker is still working on
+    def renew(self, a_numbers):
+        def extend(cursor):
+            now = time.time()
+            cursor.executemany('UPDATE work SET lease_expires = ?, updated = ? WHERE anum = ? AND state = ? AND '
+                               'owner = ?', ((now + self.lease_seconds, now, a, LEASED, self.worker_id)
+                                             for a in a_numbers))
+        self.transaction(extend)
+
+    def complete(self, a_number, succeeded=True):
+        def finish(cursor):
+            cursor.execute('UPDATE work SET state = ?, lease_expires = NULL, updated = ? WHERE anum = ? AND owner = ?',
+                           (DONE if succeeded else FAILED, time.time(), a_number, self.worker_id))
+        self.transaction(finish)
+
+    # Hand back leases that were never started, e.g. when this worker stops early
+    def release(self, a_numbers):
+        def give_back(cursor):
+            cursor.executemany('UPDATE work SET state = ?, owner = NULL, lease_expires = NULL, updated = ? '
+                               'WHERE anum = ? AND owner = ? AND state = ?',
+                               ((PENDING, time.time(), a, self.worker_id, LEASED) for a in a_numbers))
+        self.transaction(give_back)
+
+    def counts(self):
+        with self.lock:
+            rows = self.connection.execute('SELECT state, COUNT(*) FROM work GROUP BY state').fetchall()
+        return collections.Counter(dict(rows))
+
+    # True while another worker holds an unexpired lease that could still expire back to us
+    def has_live_leases(self):
+        with self.lock:
+            row = self.connection.execute('SELECT COUNT(*) FROM work WHERE state = ? AND lease_expires >= ?',
+                                          (LEASED, time.time())).fetchone()
+        return row[0] > 0
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+# Drop-in for the crawler's Queue.Queue: get() serves ANums from leased batches and raises Queue.Empty once the shared
+# store has nothing left to lease and no other worker holds a lease that might still expire.
+class LeasedQueue(object):
+    def __init__(self, lease_store, batch_size=50, poll_interval=5.0):
+        self.leases = lease_store
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.local = collections.deque()
+        self.active = set()  # Leased and not yet completed
+        self.lock = threading.Lock()
+        self.stop_signal = threading.Event()
+        self.heartbeat = threading.Thread(target=self.renew_leases)
+        self.heartbeat.daemon = True
+        self.heartbeat.start()
+
+    def renew_leases(self):
+        while not self.stop_signal.wait(self.leases.lease_seconds / 3.0):
+            # noinspection PyBroadException
+            try:
+                with self.lock:
+                    a_numbers = list(self.active)
+                self.leases.renew(a_numbers)
+            except Exception:
+                logging.warning('Could not renew leases for worker {0}.'.format(self.leases.worker_id))
+
+    # block and timeout are accepted for compatibility with Queue.Queue
+    # noinspection PyUnusedLocal
+    def get(self, block=True, timeout=None):
+        while True:
+            with self.lock:
+                if not self.local:
+                    batch = self.leases.lease_batch(self.batch_size)
+                    if batch:
+                        logging.info('Worker {0} leased {1} ANum(s).'.format(self.leases.worker_id, len(batch)))
+                        self.local.extend(batch)
+                        self.active.update(batch)
+                if self.local:
+                    return self.local.popleft()
+                if not self.leases.has_live_leases():
+                    raise Queue.Empty()
+            # Wait outside the lock so lease renewals and completions carry on
+            time.sleep(self.poll_interval)
+
+    def complete(self, a_number, succeeded=True):
+        self.leases.complete(a_number, succeeded)
+        with self.lock:
+            self.active.discard(a_number)
+
+    def qsize(self):
+        return len(self.local)
+
+    def close(self):
+        self.stop_signal.set()
+        with self.lock:
+            if self.local:
+                self.leases.release(list(self.local))
+                self.active.difference_update(self.local)
+                self.local.clear()